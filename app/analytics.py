@@ -1,8 +1,93 @@
 """Analytics calculations"""
-from datetime import timedelta
+import asyncio
+import logging
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import Dict, List, Set, Tuple
+from uuid import uuid4
 
-from models import EventDocument
 from helpers import parse_date
+from config import ANALYTICS_MAX_TIME_MS
+from archive import cold_days, archived_days, daily_users, event_type_counts, archived_stats
+from columnar import store
+from profiling import record_query
+from storage import OCCURRED_AT, USER_ID, EVENT_TYPE, events_collection, event_types
+
+logger = logging.getLogger(__name__)
+
+
+async def kill_tagged(collection, comment: str) -> int:
+    """killOp every server operation tagged with `comment`"""
+    admin = collection.database.client.admin
+    ops = await admin.aggregate([
+        {"$currentOp": {}}, {"$match": {"command.comment": comment}}
+    ]).to_list(None)
+    for op in ops:
+        await admin.command("killOp", op=op["opid"])
+    return len(ops)
+
+
+async def _aggregate(pipeline: list):
+    """Aggregate with a server-side time budget, killed on the server if cancelled"""
+    started = time.perf_counter()
+    collection = events_collection()
+    # $group pipelines do all their work before the first batch, and Motor runs that command
+    # on a thread that cancellation does not stop: the comment finds it for killOp
+    comment = f"analytics:{uuid4().hex}"
+    cursor = collection.aggregate(pipeline, maxTimeMS=ANALYTICS_MAX_TIME_MS, comment=comment)
+    try:
+        async for doc in cursor:
+            yield doc
+    except asyncio.CancelledError:
+        try:
+            await asyncio.shield(kill_tagged(collection, comment))
+        except Exception as e:
+            logger.warning(f"Could not kill cancelled query {comment}: {e}")
+        raise
+    finally:
+        await cursor.close()
+        record_query(collection, pipeline, started)
+
+
+async def _cold_users(day: datetime) -> Set[int]:
+    """Distinct users of an archived day (empty if the day is hot)"""
+    if not cold_days(day, day + timedelta(days=1)):
+        return set()
+    users = await asyncio.to_thread(daily_users, [day])
+    return users[day.strftime("%Y-%m-%d")]
+
+
+async def _cold_dau(start: datetime, end: datetime) -> Dict[str, int]:
+    """DAU for archived days, merged with any late events still in MongoDB"""
+    days = cold_days(start, end)
+    if not days:
+        return {}
+
+    users = await asyncio.to_thread(daily_users, days)
+    pipeline = [
+        {"$match": {"$or": [
+            {OCCURRED_AT: {"$gte": day, "$lt": day + timedelta(days=1)}} for day in days
+        ]}},
+        {"$group": {
+            "_id": {"$dateToString": {"format": "%Y-%m-%d", "date": f"${OCCURRED_AT}"}},
+            "users": {"$addToSet": f"${USER_ID}"}
+        }}
+    ]
+    async for doc in _aggregate(pipeline):
+        users[doc["_id"]].update(doc["users"])
+
+    return {date: len(day_users) for date, day_users in users.items()}
+
+
+async def day_users(day: datetime) -> Set[int]:
+    """Distinct users active on a UTC day, from MongoDB and the archive"""
+    pipeline = [
+        {"$match": {OCCURRED_AT: {"$gte": day, "$lt": day + timedelta(days=1)}}},
+        {"$group": {"_id": f"${USER_ID}"}}
+    ]
+    users = {doc["_id"] async for doc in _aggregate(pipeline)}
+    return users | await _cold_users(day)
 
 
 async def calculate_dau(from_date: str, to_date: str):
@@ -13,22 +98,51 @@ async def calculate_dau(from_date: str, to_date: str):
     if start > end:
         raise ValueError("from_date must be before to_date")
 
+    if store.loaded:
+        daily = await store.dau(start, end)
+    else:
+        pipeline = [
+            {"$match": {OCCURRED_AT: {"$gte": start, "$lt": end}}},
+            {"$project": {
+                "date": {"$dateToString": {"format": "%Y-%m-%d", "date": f"${OCCURRED_AT}"}},
+                USER_ID: 1
+            }},
+            {"$group": {"_id": {"date": "$date", "user_id": f"${USER_ID}"}}},
+            {"$group": {"_id": "$_id.date", "unique_users": {"$sum": 1}}},
+            {"$sort": {"_id": 1}}
+        ]
+
+        daily = {}
+        async for doc in _aggregate(pipeline):
+            daily[doc["_id"]] = doc["unique_users"]
+        daily.update(await _cold_dau(start, end))
+
+    result = [{"date": date, "dau": daily[date]} for date in sorted(daily)]
+
+    return {"from": from_date, "to": to_date, "data": result}
+
+
+async def _top_event_counts(start: datetime, end: datetime, limit: int) -> List[Tuple[str, int]]:
+    """Top event types from MongoDB merged with the archive"""
     pipeline = [
-        {"$match": {"occurred_at": {"$gte": start, "$lt": end}}},
-        {"$project": {
-            "date": {"$dateToString": {"format": "%Y-%m-%d", "date": "$occurred_at"}},
-            "user_id": 1
-        }},
-        {"$group": {"_id": {"date": "$date", "user_id": "$user_id"}}},
-        {"$group": {"_id": "$_id.date", "unique_users": {"$sum": 1}}},
-        {"$sort": {"_id": 1}}
+        {"$match": {OCCURRED_AT: {"$gte": start, "$lt": end}}},
+        {"$group": {"_id": f"${EVENT_TYPE}", "count": {"$sum": 1}}},
+        {"$sort": {"count": -1}},
+        {"$limit": limit}
     ]
 
-    result = []
-    async for doc in EventDocument.aggregate(pipeline):
-        result.append({"date": doc["_id"], "dau": doc["unique_users"]})
+    cold = cold_days(start, end)
+    if cold:
+        # Counts are merged with the archive before the limit is applied
+        pipeline = pipeline[:-1]
 
-    return {"from": from_date, "to": to_date, "data": result}
+    counts = Counter()
+    async for doc in _aggregate(pipeline):
+        counts[await event_types.decode(doc["_id"])] += doc["count"]
+    if cold:
+        counts.update(await asyncio.to_thread(event_type_counts, cold))
+
+    return counts.most_common(limit)
 
 
 async def calculate_top_events(from_date: str, to_date: str, limit: int):
@@ -36,72 +150,88 @@ async def calculate_top_events(from_date: str, to_date: str, limit: int):
     start = parse_date(from_date)
     end = parse_date(to_date) + timedelta(days=1)
 
-    pipeline = [
-        {"$match": {"occurred_at": {"$gte": start, "$lt": end}}},
-        {"$group": {"_id": "$event_type", "count": {"$sum": 1}}},
-        {"$sort": {"count": -1}},
-        {"$limit": limit}
-    ]
+    if store.loaded:
+        top = await store.top_events(start, end, limit)
+    else:
+        top = await _top_event_counts(start, end, limit)
 
-    result = []
-    async for doc in EventDocument.aggregate(pipeline):
-        result.append({"event_type": doc["_id"], "count": doc["count"]})
+    result = [{"event_type": event_type, "count": count} for event_type, count in top]
 
     return {"from": from_date, "to": to_date, "limit": limit, "data": result}
 
 
-async def calculate_retention(start_date: str, windows: int):
-    """Cohort retention analysis"""
-    cohort_start = parse_date(start_date)
+async def _retention_counts(cohort_start: datetime, windows: int) -> Tuple[int, List[int]]:
+    """Cohort size and retained users per window from MongoDB merged with the archive"""
     cohort_end = cohort_start + timedelta(days=1)
 
     pipeline = [
         {"$match": {
-            "occurred_at": {
+            OCCURRED_AT: {
                 "$gte": cohort_start,
                 "$lt": cohort_end
             }
         }},
-        {"$group": {"_id": "$user_id"}}
+        {"$group": {"_id": f"${USER_ID}"}}
     ]
 
-    cohort_users_cursor = EventDocument.aggregate(pipeline)
+    cohort_users_cursor = _aggregate(pipeline)
     cohort_users = [doc["_id"] async for doc in cohort_users_cursor]
+    cohort_set = set(cohort_users) | await _cold_users(cohort_start)
+    cohort_users = list(cohort_set)
 
-    cohort_size = len(cohort_users)
-    if cohort_size == 0:
-        return {
-            "cohort_date": start_date,
-            "cohort_size": 0,
-            "windows": windows,
-            "retention": []
-        }
+    if not cohort_users:
+        return 0, []
 
-    retention_data = []
+    retained_counts = []
     for window in range(windows):
         window_start = cohort_start + timedelta(days=window + 1)
         window_end = window_start + timedelta(days=1)
 
         retention_pipeline = [
             {"$match": {
-                "user_id": {"$in": cohort_users},
-                "occurred_at": {
+                USER_ID: {"$in": cohort_users},
+                OCCURRED_AT: {
                     "$gte": window_start,
                     "$lt": window_end
                 }
             }},
-            {"$group": {"_id": "$user_id"}}
+            {"$group": {"_id": f"${USER_ID}"}}
         ]
 
-        retained_cursor = EventDocument.aggregate(retention_pipeline)
-        retained = [doc["_id"] async for doc in retained_cursor]
+        retained_cursor = _aggregate(retention_pipeline)
+        retained = {doc["_id"] async for doc in retained_cursor}
+        retained |= await _cold_users(window_start) & cohort_set
+        retained_counts.append(len(retained))
+
+    return len(cohort_users), retained_counts
 
-        rate = (len(retained) / cohort_size * 100) if cohort_size > 0 else 0
+
+async def calculate_retention(start_date: str, windows: int):
+    """Cohort retention analysis"""
+    cohort_start = parse_date(start_date)
+
+    if store.loaded:
+        cohort_size, retained_counts = await store.retention(cohort_start, windows)
+    else:
+        cohort_size, retained_counts = await _retention_counts(cohort_start, windows)
+
+    if cohort_size == 0:
+        return {
+            "cohort_date": start_date,
+            "cohort_size": 0,
+            "windows": windows,
+            "retention": []
+        }
+
+    retention_data = []
+    for window, retained in enumerate(retained_counts):
+        window_start = cohort_start + timedelta(days=window + 1)
+        rate = (retained / cohort_size * 100) if cohort_size > 0 else 0
 
         retention_data.append({
             "day": window + 1,
             "date": window_start.strftime("%Y-%m-%d"),
-            "retained_users": len(retained),
+            "retained_users": retained,
             "retention_rate": round(rate, 2)
         })
 
@@ -115,26 +245,30 @@ async def calculate_retention(start_date: str, windows: int):
 
 async def get_metrics():
     """System metrics"""
-    total = await EventDocument.count()
+    collection = events_collection()
+    total = await collection.count_documents({})
 
-    pipeline = [
-        {"$group": {"_id": "$event_type", "count": {"$sum": 1}}},
-        {"$sort": {"count": -1}},
-        {"$limit": 5}
-    ]
+    # Every type's count is needed to merge with the archive before taking the top 5
+    pipeline = [{"$group": {"_id": f"${EVENT_TYPE}", "count": {"$sum": 1}}}]
 
-    top_types = []
-    async for doc in EventDocument.aggregate(pipeline):
-        top_types.append({"event_type": doc["_id"], "count": doc["count"]})
+    counts = Counter()
+    async for doc in _aggregate(pipeline):
+        counts[await event_types.decode(doc["_id"])] += doc["count"]
+    counts.update(await asyncio.to_thread(lambda: event_type_counts(archived_days())))
+    top_types = [
+        {"event_type": event_type, "count": count} for event_type, count in counts.most_common(5)
+    ]
 
-    oldest = await EventDocument.find_one(sort=[("occurred_at", 1)])
-    newest = await EventDocument.find_one(sort=[("occurred_at", -1)])
+    oldest = await collection.find_one({}, {OCCURRED_AT: 1}, sort=[(OCCURRED_AT, 1)])
+    newest = await collection.find_one({}, {OCCURRED_AT: 1}, sort=[(OCCURRED_AT, -1)])
+    archived = await asyncio.to_thread(archived_stats)
 
     return {
-        "total_events": total,
+        "total_events": total + archived["events"],
+        "archived_events": archived["events"],
         "top_event_types": top_types,
         "date_range": {
-            "oldest": oldest.occurred_at.isoformat() if oldest else None,
-            "newest": newest.occurred_at.isoformat() if newest else None
+            "oldest": archived["oldest"] or (oldest[OCCURRED_AT].isoformat() if oldest else None),
+            "newest": newest[OCCURRED_AT].isoformat() if newest else None
         }
     }
\ No newline at end of file
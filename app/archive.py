@@ -0,0 +1,208 @@
+"""Cold-tier archival of old events to Parquet segments"""
+import asyncio
+import json
+import logging
+import os
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple
+from uuid import UUID
+
+from storage import OCCURRED_AT, events_collection, find_events
+from config import ARCHIVE_DIR, ARCHIVE_AFTER_DAYS, ARCHIVE_COMPRESSION
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # archive is optional, hot-only deployments run without pyarrow
+    pa = pq = None
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_PREFIX = "events-"
+DELETE_BATCH = 1000
+TYPE_COUNTS_KEY = b"event_type_counts"  # footer metadata: JSON of events per type
+
+_summaries: Dict[Path, Tuple[int, int, Counter]] = {}  # path -> (mtime_ns, rows, type counts)
+
+SCHEMA = pa.schema([
+    ("event_id", pa.binary(16)),
+    ("occurred_at", pa.timestamp("us", tz="UTC")),
+    ("user_id", pa.int64()),
+    ("event_type", pa.dictionary(pa.int32(), pa.string())),
+    ("properties_json", pa.string()),
+    ("ingested_at", pa.timestamp("us", tz="UTC")),
+]) if pa else None
+
+
+def segment_path(day: datetime) -> Path:
+    """One segment file per UTC day"""
+    return Path(ARCHIVE_DIR) / f"{SEGMENT_PREFIX}{day.strftime('%Y-%m-%d')}.parquet"
+
+
+def cold_days(start: datetime, end: datetime) -> List[datetime]:
+    """Days in [start, end) that have an archived segment"""
+    if pq is None or not Path(ARCHIVE_DIR).is_dir():
+        return []
+    days, day = [], start
+    while day < end:
+        if segment_path(day).exists():
+            days.append(day)
+        day += timedelta(days=1)
+    return days
+
+
+def archived_days() -> List[datetime]:
+    """Every day that has an archived segment"""
+    if pq is None or not Path(ARCHIVE_DIR).is_dir():
+        return []
+    return [
+        datetime.strptime(path.stem[len(SEGMENT_PREFIX):], "%Y-%m-%d")
+        for path in sorted(Path(ARCHIVE_DIR).glob(f"{SEGMENT_PREFIX}*.parquet"))
+    ]
+
+
+def read_segment(day: datetime, columns: List[str], filters: Optional[list] = None) -> "pa.Table":
+    """Read selected columns (and matching rows) of a segment via memory-mapping"""
+    return pq.read_table(segment_path(day), columns=columns, filters=filters, memory_map=True)
+
+
+def daily_users(days: List[datetime]) -> Dict[str, Set[int]]:
+    """Distinct user ids per archived day"""
+    result = {}
+    for day in days:
+        users = read_segment(day, ["user_id"]).column("user_id")
+        result[day.strftime("%Y-%m-%d")] = set(users.unique().to_pylist())
+    return result
+
+
+def _type_counts(table: "pa.Table") -> Counter:
+    counts = Counter()
+    for row in table.column("event_type").value_counts().to_pylist():
+        counts[row["values"]] += row["counts"]
+    return counts
+
+
+def segment_summary(path: Path) -> Tuple[int, Counter]:
+    """Row count and events per type of a segment, from its footer (cached until it changes)"""
+    mtime = path.stat().st_mtime_ns
+    cached = _summaries.get(path)
+    if cached is None or cached[0] != mtime:
+        parquet = pq.ParquetFile(path, memory_map=True)
+        metadata = parquet.schema_arrow.metadata or {}
+        if TYPE_COUNTS_KEY in metadata:
+            counts = Counter(json.loads(metadata[TYPE_COUNTS_KEY]))
+        else:  # written before the counts were kept in the footer
+            counts = _type_counts(parquet.read(columns=["event_type"]))
+        cached = _summaries[path] = (mtime, parquet.metadata.num_rows, counts)
+    return cached[1], cached[2]
+
+
+def event_type_counts(days: List[datetime]) -> Counter:
+    """Event counts per type over archived days"""
+    counts = Counter()
+    for day in days:
+        counts.update(segment_summary(segment_path(day))[1])
+    return counts
+
+
+def archived_stats() -> Dict[str, Optional[object]]:
+    """Row count and oldest day from segment footers"""
+    if pq is None or not Path(ARCHIVE_DIR).is_dir():
+        return {"events": 0, "oldest": None}
+    paths = sorted(Path(ARCHIVE_DIR).glob(f"{SEGMENT_PREFIX}*.parquet"))
+    total = sum(segment_summary(p)[0] for p in paths)
+    oldest = paths[0].stem[len(SEGMENT_PREFIX):] if paths else None
+    return {"events": total, "oldest": oldest}
+
+
+def _event_id_bytes(value) -> bytes:
+    return value.bytes if isinstance(value, UUID) else bytes(value)
+
+
+def _write_segment(day: datetime, columns: Dict[str, list]):
+    """Write (or extend) a day's segment atomically"""
+    path = segment_path(day)
+    table = pa.Table.from_pydict(columns, schema=SCHEMA)
+
+    if path.exists():
+        existing = pq.read_table(path, memory_map=True)
+        known = set(existing.column("event_id").to_pylist())
+        keep = [event_id not in known for event_id in columns["event_id"]]
+        table = pa.concat_tables([existing, table.filter(pa.array(keep))]).unify_dictionaries()
+
+    # Per-type counts in the footer spare /metrics a scan of every segment's event_type column
+    table = table.replace_schema_metadata({TYPE_COUNTS_KEY: json.dumps(_type_counts(table))})
+    tmp = path.with_suffix(".tmp")
+    pq.write_table(table, tmp, compression=ARCHIVE_COMPRESSION)
+    os.replace(tmp, path)
+
+
+async def archive_day(day: datetime) -> int:
+    """Move one closed day from MongoDB into its cold segment"""
+    columns = defaultdict(list)
+    ids = []
+
+    events = find_events(
+        {"occurred_at": {"$gte": day, "$lt": day + timedelta(days=1)}}, sort_by_time=True
+    )
+    async for doc in events:
+        ids.append(doc["_id"])
+        columns["event_id"].append(_event_id_bytes(doc["event_id"]))
+        columns["occurred_at"].append(doc["occurred_at"])
+        columns["user_id"].append(doc["user_id"])
+        columns["event_type"].append(doc["event_type"])
+        columns["properties_json"].append(json.dumps(doc.get("properties", {})))
+        columns["ingested_at"].append(doc.get("ingested_at"))
+
+    if not ids:
+        return 0
+
+    Path(ARCHIVE_DIR).mkdir(parents=True, exist_ok=True)
+    await asyncio.to_thread(_write_segment, day, columns)
+
+    # Delete by _id only after the segment is on disk, so late arrivals stay hot
+    collection = events_collection()
+    for i in range(0, len(ids), DELETE_BATCH):
+        await collection.delete_many({"_id": {"$in": ids[i:i + DELETE_BATCH]}})
+
+    logger.warning(f"Archived {len(ids)} events for {day.strftime('%Y-%m-%d')}")
+    return len(ids)
+
+
+async def archive_closed(now: Optional[datetime] = None) -> int:
+    """Archive every day older than ARCHIVE_AFTER_DAYS"""
+    if pq is None:
+        raise RuntimeError("pyarrow is required for archiving")
+
+    now = now or datetime.utcnow()
+    cutoff = datetime(now.year, now.month, now.day) - timedelta(days=ARCHIVE_AFTER_DAYS)
+
+    oldest = await events_collection().find_one({}, {OCCURRED_AT: 1}, sort=[(OCCURRED_AT, 1)])
+    if not oldest:
+        return 0
+
+    first = oldest[OCCURRED_AT].replace(tzinfo=None)
+    day = datetime(first.year, first.month, first.day)
+    total = 0
+    while day < cutoff:
+        total += await archive_day(day)
+        day += timedelta(days=1)
+    return total
+
+
+async def main():
+    from db import connect_db, disconnect_db
+
+    logging.basicConfig(level=logging.WARNING, format='{"time":"%(asctime)s","msg":"%(message)s"}')
+    await connect_db()
+    try:
+        total = await archive_closed()
+        logger.warning(f"Archive run finished, moved {total} events")
+    finally:
+        await disconnect_db()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
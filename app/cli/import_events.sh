@@ -9,41 +9,41 @@ docker exec "$CONTAINER" python -c """
 import asyncio
 import csv
 import json
-import os
 from uuid import UUID
 from datetime import datetime
-from pathlib import Path
-from motor.motor_asyncio import AsyncIOMotorClient
-from config import MONGODB_HOST, MONGODB_PORT, MONGODB_USER, MONGODB_PASSWORD, MONGODB_DB
-from models import EventDocument
-from beanie import init_beanie
+from db import connect_db, disconnect_db
+from storage import insert_events, events_collection
+from sketches import record_sketches
 
-async def import_csv():
-
-    mongo_url = os.getenv('MONGODB_URL')
-    client = AsyncIOMotorClient(mongo_url)
-    await init_beanie(database=client[MONGODB_DB], document_models=[EventDocument])
-
-    batch = []
-    with open('/tmp/import.csv', 'r') as f:
-        for row in csv.DictReader(f):
-            event = EventDocument(
-                event_id=UUID(row['event_id']),
-                occurred_at=datetime.fromisoformat(row['occurred_at'].replace('Z', '+00:00')),
-                user_id=int(row['user_id']),
-                event_type=row['event_type'],
-                properties=json.loads(row['properties_json']),
-                ingested_at=datetime.utcnow()
-            )
-            batch.append(event)
-            if len(batch) >= 1000:
-                await EventDocument.insert_many(batch, ordered=False)
-                batch = []
+# Same path as the seed and the worker: stored layout (long or compact) plus sketches
+async def store(batch):
+    await insert_events(batch)
+    await record_sketches((e['occurred_at'], e['event_type'], e['properties']) for e in batch)
 
-    if batch:
-        await EventDocument.insert_many(batch, ordered=False)
-
-    print(f'Imported {await EventDocument.count()} events')
+async def import_csv():
+    await connect_db()
+    try:
+        batch = []
+        with open('/tmp/import.csv', 'r') as f:
+            for row in csv.DictReader(f):
+                batch.append({
+                    'event_id': UUID(row['event_id']),
+                    'occurred_at': datetime.fromisoformat(row['occurred_at'].replace('Z', '+00:00')),
+                    'user_id': int(row['user_id']),
+                    'event_type': row['event_type'],
+                    'properties': json.loads(row['properties_json']),
+                    'ingested_at': datetime.utcnow()
+                })
+                if len(batch) >= 1000:
+                    await store(batch)
+                    batch = []
+
+        if batch:
+            await store(batch)
+
+        print(f'Imported {await events_collection().count_documents({})} events')
+    finally:
+        await disconnect_db()
 
 asyncio.run(import_csv())
-"""
\ No newline at end of file
+"""
@@ -0,0 +1,192 @@
+"""Stored cohort retention matrix, maintained as days close"""
+import argparse
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import Dict, Optional, Set
+
+from pymongo import UpdateOne
+
+from models import RetentionCohortDocument
+from helpers import parse_date
+from analytics import day_users
+from archive import archived_stats
+from storage import OCCURRED_AT, events_collection
+from config import RETENTION_MATRIX_WINDOWS, RETENTION_MATRIX_REFRESH_SECONDS
+
+logger = logging.getLogger(__name__)
+
+DAY = timedelta(days=1)
+
+
+def _today(now: Optional[datetime] = None) -> datetime:
+    now = now or datetime.utcnow()
+    return datetime(now.year, now.month, now.day)
+
+
+def _collection():
+    return RetentionCohortDocument.get_motor_collection()
+
+
+def retention_row(doc: dict, windows: int) -> dict:
+    """API row for a stored cohort, limited to `windows` closed windows"""
+    size = doc["size"]
+    retention = []
+    for window, retained in enumerate(doc.get("retained", [])[:windows]):
+        if retained is None:
+            continue
+        retention.append({
+            "day": window + 1,
+            "date": (doc["cohort"] + (window + 1) * DAY).strftime("%Y-%m-%d"),
+            "retained_users": retained,
+            "retention_rate": round(retained / size * 100, 2) if size else 0
+        })
+    return {
+        "cohort_date": doc["cohort"].strftime("%Y-%m-%d"),
+        "cohort_size": size,
+        "retention": retention
+    }
+
+
+async def calculate_retention_matrix(from_date: str, to_date: str, windows: int):
+    """Retention triangle for a range of cohort days, read from the stored matrix"""
+    start = parse_date(from_date)
+    end = parse_date(to_date)
+    if start > end:
+        raise ValueError("from_date must be before to_date")
+
+    cursor = _collection().find(
+        {"cohort": {"$gte": start, "$lte": end}}, {"_id": 0}
+    ).sort("cohort", 1)
+    data = [retention_row(doc, windows) async for doc in cursor]
+
+    return {"from": from_date, "to": to_date, "windows": windows, "data": data}
+
+
+async def _users(day: datetime, cache: Dict[datetime, Set[int]]) -> Set[int]:
+    if day not in cache:
+        cache[day] = await day_users(day)
+    return cache[day]
+
+
+async def close_day(
+    day: datetime,
+    cache: Dict[datetime, Set[int]],
+    first_cohort: Optional[datetime] = None,
+    last_cohort: Optional[datetime] = None
+):
+    """Write cohort `day` and the window `day` fills for each earlier cohort"""
+    def in_range(cohort):
+        return (first_cohort or cohort) <= cohort <= (last_cohort or cohort)
+
+    collection = _collection()
+    users = await _users(day, cache)
+    now = datetime.utcnow()
+
+    if in_range(day):
+        await collection.update_one(
+            {"cohort": day},
+            {"$set": {"size": len(users), "retained": [], "updated_at": now}},
+            upsert=True
+        )
+
+    earliest = day - RETENTION_MATRIX_WINDOWS * DAY
+    cursor = collection.find({"cohort": {"$gte": earliest, "$lt": day}, "size": {"$gt": 0}})
+    ops = []
+    async for doc in cursor:
+        cohort = doc["cohort"]
+        if not in_range(cohort):
+            continue
+        window = (day - cohort).days
+        retained = len(await _users(cohort, cache) & users)
+        ops.append(UpdateOne(
+            {"_id": doc["_id"]},
+            {"$set": {f"retained.{window - 1}": retained, "updated_at": now}}
+        ))
+    if ops:
+        await collection.bulk_write(ops, ordered=False)
+
+    # Only the last RETENTION_MATRIX_WINDOWS days can still be intersected
+    for cached in [d for d in cache if d <= earliest]:
+        del cache[cached]
+
+
+async def _first_day() -> Optional[datetime]:
+    """Day of the oldest event, hot or archived"""
+    days = []
+    oldest = await events_collection().find_one({}, {OCCURRED_AT: 1}, sort=[(OCCURRED_AT, 1)])
+    if oldest:
+        days.append(_today(oldest[OCCURRED_AT].replace(tzinfo=None)))
+    archived = (await asyncio.to_thread(archived_stats))["oldest"]
+    if archived:
+        days.append(parse_date(archived))
+    return min(days) if days else None
+
+
+async def close_days(now: Optional[datetime] = None) -> int:
+    """Bring the matrix up to date with every closed day since the last run"""
+    last = await _collection().find_one({}, {"cohort": 1}, sort=[("cohort", -1)])
+    day = last["cohort"] + DAY if last else await _first_day()
+    if day is None:
+        return 0
+
+    today, cache, closed = _today(now), {}, 0
+    while day < today:
+        await close_day(day, cache)
+        day += DAY
+        closed += 1
+    if closed:
+        logger.warning(f"Retention matrix updated through {(day - DAY).strftime('%Y-%m-%d')}")
+    return closed
+
+
+async def recompute(from_date: str, to_date: str, now: Optional[datetime] = None) -> int:
+    """Recompute every cell touched by (late) events that occurred on [from_date, to_date]"""
+    first_cohort = parse_date(from_date) - RETENTION_MATRIX_WINDOWS * DAY
+    last_cohort = parse_date(to_date)
+    first_day = await _first_day()
+    if first_day is None:
+        return 0
+    first_cohort = max(first_cohort, first_day)
+    stop = min(last_cohort + (RETENTION_MATRIX_WINDOWS + 1) * DAY, _today(now))
+
+    day, cache, days = first_cohort, {}, 0
+    while day < stop:
+        await close_day(day, cache, first_cohort, last_cohort)
+        day += DAY
+        days += 1
+    return days
+
+
+async def keep_current():
+    """Close new days into the matrix periodically"""
+    while True:
+        try:
+            await close_days()
+        except Exception as e:
+            logger.error(f"Retention matrix update failed: {e}")
+        await asyncio.sleep(RETENTION_MATRIX_REFRESH_SECONDS)
+
+
+async def main():
+    from db import connect_db, disconnect_db
+
+    parser = argparse.ArgumentParser(description="Maintain the stored retention matrix")
+    parser.add_argument("from_date", nargs="?", help="first day with late events")
+    parser.add_argument("to_date", nargs="?", help="last day with late events")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format='{"time":"%(asctime)s","msg":"%(message)s"}')
+    await connect_db()
+    try:
+        if args.from_date:
+            days = await recompute(args.from_date, args.to_date or args.from_date)
+            logger.warning(f"Recomputed retention matrix over {days} days")
+        else:
+            await close_days()
+    finally:
+        await disconnect_db()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
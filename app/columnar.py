@@ -0,0 +1,226 @@
+"""In-memory columnar snapshot of the event store"""
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from bson import ObjectId
+
+from storage import OCCURRED_AT, USER_ID, EVENT_TYPE, events_collection, event_types
+from config import COLUMNAR_REFRESH_SECONDS, COLUMNAR_LAG_SECONDS
+
+try:
+    import numpy as np
+except ImportError:  # engine is optional, analytics falls back to aggregation pipelines
+    np = None
+
+logger = logging.getLogger(__name__)
+
+EPOCH = datetime(1970, 1, 1)
+MS_PER_DAY = 86_400_000
+LOAD_BATCH = 100_000
+INT32_MAX = 2**31 - 1
+
+
+def day_offset(day: datetime) -> int:
+    """Days since the Unix epoch"""
+    return (day - EPOCH).days
+
+
+class ColumnarStore:
+    """Columns for user_id, day offset, event_type code and occurred_at"""
+
+    def __init__(self):
+        self.loaded = False
+        self.size = 0
+        self.watermark: Optional[ObjectId] = None
+        self.event_types: List[str] = []
+        self.event_codes: Dict[str, int] = {}
+        self.user_id = self.day = self.event_type = self.occurred_at = None
+
+    def _encode(self, event_type: str) -> int:
+        code = self.event_codes.get(event_type)
+        if code is None:
+            code = self.event_codes[event_type] = len(self.event_types)
+            self.event_types.append(event_type)
+        return code
+
+    def _reserve(self, extra: int):
+        """Grow column buffers geometrically"""
+        needed = self.size + extra
+        if self.user_id is not None and needed <= len(self.user_id):
+            return
+        current = len(self.user_id) if self.user_id is not None else 0
+        capacity = max(needed, 2 * current, LOAD_BATCH)
+        for name, dtype in (("user_id", np.int32), ("day", np.int16),
+                            ("event_type", np.int16), ("occurred_at", np.int64)):
+            column = np.empty(capacity, dtype=dtype)
+            old = getattr(self, name)
+            if old is not None:
+                column[:self.size] = old[:self.size]
+            setattr(self, name, column)
+
+    def append(self, user_ids: List[int], occurred_ms: List[int], event_types: List[str]):
+        """Append one batch of rows"""
+        codes = np.fromiter(
+            (self._encode(t) for t in event_types), dtype=np.int16, count=len(event_types)
+        )
+        self.append_encoded(user_ids, occurred_ms, codes)
+
+    def append_encoded(self, user_ids, occurred_ms, codes):
+        """Append one batch of rows with event types already encoded"""
+        if len(user_ids) == 0:
+            return
+        users = np.asarray(user_ids, dtype=np.int64)
+        if users.max() > INT32_MAX:
+            raise ValueError("user_id does not fit the int32 column")
+
+        occurred = np.asarray(occurred_ms, dtype=np.int64)
+
+        n = len(users)
+        self._reserve(n)
+        end = self.size + n
+        self.user_id[self.size:end] = users
+        self.occurred_at[self.size:end] = occurred
+        self.day[self.size:end] = occurred // MS_PER_DAY
+        self.event_type[self.size:end] = codes
+        self.size = end
+
+    def _columns(self):
+        # Rows below size are never rewritten, so these views stay valid while
+        # a worker thread scans them and the event loop keeps appending
+        n = self.size
+        return self.user_id[:n], self.day[:n], self.event_type[:n]
+
+    async def dau(self, start: datetime, end: datetime) -> Dict[str, int]:
+        """Distinct users per day in [start, end)"""
+        users, days, _ = self._columns()
+        return await asyncio.to_thread(_dau, users, days, start, end)
+
+    async def top_events(
+        self, start: datetime, end: datetime, limit: int
+    ) -> List[Tuple[str, int]]:
+        """Event counts per type in [start, end), largest first"""
+        _, days, codes = self._columns()
+        names = list(self.event_types)
+        return await asyncio.to_thread(_top_events, days, codes, names, start, end, limit)
+
+    async def retention(self, cohort_day: datetime, windows: int) -> Tuple[int, List[int]]:
+        """Cohort size and retained users for each following day"""
+        users, days, _ = self._columns()
+        return await asyncio.to_thread(_retention, users, days, cohort_day, windows)
+
+
+def _dau(users, days, start: datetime, end: datetime) -> Dict[str, int]:
+    mask = (days >= day_offset(start)) & (days < day_offset(end))
+    pairs = np.unique((days[mask].astype(np.int64) << 32) | users[mask].astype(np.int64))
+    unique_days, counts = np.unique(pairs >> 32, return_counts=True)
+    return {
+        (EPOCH + timedelta(days=int(d))).strftime("%Y-%m-%d"): int(c)
+        for d, c in zip(unique_days, counts)
+    }
+
+
+def _top_events(
+    days, codes, names: List[str], start: datetime, end: datetime, limit: int
+) -> List[Tuple[str, int]]:
+    mask = (days >= day_offset(start)) & (days < day_offset(end))
+    counts = np.bincount(codes[mask], minlength=len(names))
+    order = np.argsort(-counts, kind="stable")[:limit]
+    return [(names[i], int(counts[i])) for i in order if counts[i] > 0]
+
+
+def _retention(users, days, cohort_day: datetime, windows: int) -> Tuple[int, List[int]]:
+    first = day_offset(cohort_day)
+    cohort = np.unique(users[days == first])
+    retained = []
+    for window in range(1, windows + 1):
+        active = np.unique(users[days == first + window])
+        retained.append(int(np.intersect1d(cohort, active, assume_unique=True).size))
+    return int(cohort.size), retained
+
+
+async def _load_archive(target: ColumnarStore):
+    """Load archived segments once at startup"""
+    from archive import pq, ARCHIVE_DIR, SEGMENT_PREFIX
+
+    if pq is None or not Path(ARCHIVE_DIR).is_dir():
+        return
+    for path in sorted(Path(ARCHIVE_DIR).glob(f"{SEGMENT_PREFIX}*.parquet")):
+        table = await asyncio.to_thread(
+            pq.read_table, path, columns=["user_id", "occurred_at", "event_type"], memory_map=True
+        )
+        table = table.unify_dictionaries().combine_chunks()
+        types = table.column("event_type").chunk(0)
+        # Map the segment's dictionary onto ours instead of decoding every row
+        mapping = np.array(
+            [target._encode(t) for t in types.dictionary.to_pylist()], dtype=np.int16
+        )
+        target.append_encoded(
+            table.column("user_id").to_numpy(),
+            table.column("occurred_at").cast("int64").to_numpy() // 1000,
+            mapping[types.indices.to_numpy()]
+        )
+
+
+async def refresh(target: ColumnarStore) -> int:
+    """Load events inserted since the watermark"""
+    # Rows newer than the lag may still be in flight from other writers
+    upper = ObjectId.from_datetime(datetime.utcnow() - timedelta(seconds=COLUMNAR_LAG_SECONDS))
+    match = {"_id": {"$lt": upper}}
+    if target.watermark is not None:
+        match["_id"]["$gt"] = target.watermark
+
+    pipeline = [
+        {"$match": match},
+        {"$sort": {"_id": 1}},
+        {"$project": {"_id": 1, USER_ID: 1, EVENT_TYPE: 1, "ts": {"$toLong": f"${OCCURRED_AT}"}}}
+    ]
+
+    loaded, last_id = 0, None
+    users, occurred, types = [], [], []
+    async for doc in events_collection().aggregate(pipeline, batchSize=10_000):
+        users.append(doc[USER_ID])
+        occurred.append(doc["ts"])
+        types.append(await event_types.decode(doc[EVENT_TYPE]))
+        last_id = doc["_id"]
+        if len(users) >= LOAD_BATCH:
+            target.append(users, occurred, types)
+            target.watermark = last_id
+            loaded += len(users)
+            users, occurred, types = [], [], []
+
+    if users:
+        target.append(users, occurred, types)
+        target.watermark = last_id
+    return loaded + len(users)
+
+
+async def load(target: ColumnarStore):
+    """Initial load from the archive and MongoDB"""
+    if np is None:
+        raise RuntimeError("numpy is required for the columnar engine")
+
+    await _load_archive(target)
+    loaded = await refresh(target)
+    target.loaded = True
+    logger.warning(f"Columnar engine loaded {target.size} events ({loaded} from MongoDB)")
+
+
+async def keep_fresh(target: ColumnarStore):
+    """Periodically append newly inserted events"""
+    while True:
+        await asyncio.sleep(COLUMNAR_REFRESH_SECONDS)
+        if not target.loaded:
+            continue
+        try:
+            await refresh(target)
+        except Exception as e:
+            # A failing batch fails again at the same watermark every tick; serving the frozen
+            # snapshot would hide that, so queries fall back to the pipelines instead
+            target.loaded = False
+            logger.error(f"Columnar refresh failed, falling back to pipelines: {e}")
+
+
+store = ColumnarStore()
@@ -5,10 +5,15 @@ import logging
 import csv
 from pathlib import Path
 from uuid import UUID
+from typing import Callable, Optional
 import json
 
-from models import EventDocument
-from config import MONGODB_URL, MONGODB_DB, CSV_PATH
+from models import (
+    EventDocument, PropertySketchDocument, ExportJobDocument, RetentionCohortDocument
+)
+from config import MONGODB_URL, MONGODB_DB, MONGODB_TIMEOUT_MS, CSV_PATH, COMPACT_STORAGE
+from sketches import record_sketches
+from storage import events_collection, index_models, insert_events, event_types
 
 logger = logging.getLogger(__name__)
 
@@ -17,23 +22,44 @@ class DB:
 
 db = DB()
 
-async def connect_db():
+async def connect_db(skip_indexes: bool = False):
     """Initialize Beanie ODM"""
-    db.client = AsyncIOMotorClient(MONGODB_URL)
-    await init_beanie(
-        database=db.client[MONGODB_DB],
-        document_models=[EventDocument]
-    )
+    client = AsyncIOMotorClient(MONGODB_URL, serverSelectionTimeoutMS=MONGODB_TIMEOUT_MS)
+    try:
+        await init_beanie(
+            database=client[MONGODB_DB],
+            document_models=[
+                EventDocument, PropertySketchDocument, ExportJobDocument, RetentionCohortDocument
+            ],
+            # The compact layout lives in its own collection with renamed indexes
+            skip_indexes=skip_indexes or COMPACT_STORAGE
+        )
+    except Exception:
+        # A failed attempt must not leave a client behind for the next retry
+        client.close()
+        raise
+    db.client = client
+    if COMPACT_STORAGE and not skip_indexes:
+        await ensure_indexes()
+    await event_types.load()
     logger.warning("Database connected")
 
+async def ensure_indexes():
+    """Build model indexes (deferred when connected with skip_indexes)"""
+    await events_collection().create_indexes(index_models())
+    for model in (PropertySketchDocument, ExportJobDocument, RetentionCohortDocument):
+        await model.get_motor_collection().create_indexes(model.Settings.indexes)
+    await event_types.ensure_indexes()
+
 async def disconnect_db():
     """Close database connection"""
     if db.client:
         db.client.close()
 
-async def seed_csv():
+async def seed_csv(progress: Optional[Callable[..., None]] = None):
     """Idempotent CSV seeding"""
-    if await EventDocument.count() > 0:
+    collection = events_collection()
+    if await collection.count_documents({}) > 0:
         logger.warning(f"Database already seeded, skipping")
         return
 
@@ -43,32 +69,44 @@ async def seed_csv():
         return
 
     logger.warning(f"Seeding from {csv_path}")
-    batch, errors = [], 0
+    batch, errors, inserted = [], 0, 0
 
     with open(csv_path, 'r') as f:
         for row in csv.DictReader(f):
             try:
                 from datetime import datetime
-                event = EventDocument(
-                    event_id=UUID(row['event_id']),
-                    occurred_at=datetime.fromisoformat(row['occurred_at'].replace('Z', '+00:00')),
-                    user_id=int(row['user_id']),
-                    event_type=row['event_type'],
-                    properties=json.loads(row['properties_json']),
-                    ingested_at=datetime.utcnow()
-                )
+                event = {
+                    "event_id": UUID(row['event_id']),
+                    "occurred_at": datetime.fromisoformat(
+                        row['occurred_at'].replace('Z', '+00:00')
+                    ),
+                    "user_id": int(row['user_id']),
+                    "event_type": row['event_type'],
+                    "properties": json.loads(row['properties_json']),
+                    "ingested_at": datetime.utcnow()
+                }
                 batch.append(event)
 
                 if len(batch) >= 1000:
-                    await EventDocument.insert_many(batch, ordered=False)
+                    await insert_events(batch)
+                    await record_sketches(
+                        (e["occurred_at"], e["event_type"], e["properties"]) for e in batch
+                    )
+                    inserted += len(batch)
                     batch = []
+                    if progress:
+                        progress(inserted=inserted, errors=errors)
             except Exception as e:
                 errors += 1
                 if errors <= 3:
                     logger.error(f"Parse error: {e}")
 
     if batch:
-        await EventDocument.insert_many(batch, ordered=False)
+        await insert_events(batch)
+        await record_sketches((e["occurred_at"], e["event_type"], e["properties"]) for e in batch)
+        inserted += len(batch)
+    if progress:
+        progress(inserted=inserted, errors=errors)
 
-    total = await EventDocument.count()
+    total = await collection.count_documents({})
     logger.warning(f"Seeded {total} events, {errors} errors")
\ No newline at end of file
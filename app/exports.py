@@ -0,0 +1,303 @@
+"""Background bulk export jobs"""
+import asyncio
+import csv
+import gzip
+import io
+import json
+import logging
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import List, Optional
+from uuid import UUID, uuid4
+
+from bson.binary import Binary
+
+from models import ExportJobDocument, ExportRequest
+from storage import find_events
+from archive import cold_days, read_segment
+from helpers import parse_date
+from config import (
+    EXPORT_DIR, EXPORT_MAX_JOBS, EXPORT_PARALLEL_CHUNKS, EXPORT_BATCH_SIZE,
+    EXPORT_MAX_ROWS_PER_SECOND
+)
+
+try:
+    import zstandard
+except ImportError:  # zstd output is optional, gzip is always available
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+CSV_COLUMNS = ["event_id", "occurred_at", "user_id", "event_type", "properties_json"]
+EXPORT_FIELDS = ["event_id", "occurred_at", "user_id", "event_type", "properties"]
+EXTENSIONS = {"gzip": "gz", "zstd": "zst"}
+
+job_slots = asyncio.Semaphore(EXPORT_MAX_JOBS)
+running_jobs = set()
+
+
+class RowPacer:
+    """Caps the rows per second written across all chunks of a job"""
+
+    def __init__(self, rows_per_second: int):
+        self.rows_per_second = rows_per_second
+        self.started = time.monotonic()
+        self.rows = 0
+
+    async def wait(self, rows: int):
+        self.rows += rows
+        if self.rows_per_second <= 0:
+            return
+        ahead = self.rows / self.rows_per_second - (time.monotonic() - self.started)
+        if ahead > 0:
+            await asyncio.sleep(ahead)
+
+
+def _open(path: Path, compression: str):
+    if compression == "zstd":
+        return zstandard.open(path, "wt", encoding="utf-8")
+    return gzip.open(path, "wt", encoding="utf-8", compresslevel=6)
+
+
+def _uuid_str(value) -> str:
+    if isinstance(value, Binary):
+        return str(value.as_uuid())
+    if isinstance(value, bytes):  # archived segments store the raw 16 bytes
+        return str(UUID(bytes=value))
+    return str(value)
+
+
+def _format_rows(docs: List[dict], fmt: str) -> str:
+    """Serialize a batch in the column layout of data/events_sample.csv"""
+    rows = [
+        [
+            _uuid_str(doc["event_id"]),
+            doc["occurred_at"].isoformat() + "+00:00",
+            doc["user_id"],
+            doc["event_type"],
+            json.dumps(doc.get("properties") or {}, separators=(",", ":")),
+        ]
+        for doc in docs
+    ]
+    if fmt == "csv":
+        buffer = io.StringIO()
+        csv.writer(buffer, lineterminator="\n").writerows(rows)
+        return buffer.getvalue()
+    return "".join(
+        json.dumps(dict(zip(CSV_COLUMNS, row)), separators=(",", ":")) + "\n" for row in rows
+    )
+
+
+def split_range(start: datetime, end: datetime, parts: int) -> List[tuple]:
+    """Split [start, end) into up to `parts` whole-day chunks"""
+    days = max((end - start).days, 1)
+    step = max(-(-days // parts), 1)
+    chunks, chunk_start = [], start
+    while chunk_start < end:
+        chunk_end = min(chunk_start + timedelta(days=step), end)
+        chunks.append((chunk_start, chunk_end))
+        chunk_start = chunk_end
+    return chunks
+
+
+def segment_filters(request: ExportRequest) -> Optional[list]:
+    """build_filter for archived segments, as pyarrow row filters"""
+    filters = []
+    if request.event_type:
+        filters.append(("event_type", "=", request.event_type))
+    if request.user_id is not None:
+        filters.append(("user_id", "=", request.user_id))
+    return filters or None
+
+
+def _archived_docs(batch) -> List[dict]:
+    """Segment rows in the shape find_events returns"""
+    return [
+        {
+            "event_id": row["event_id"],
+            "occurred_at": row["occurred_at"].replace(tzinfo=None),
+            "user_id": row["user_id"],
+            "event_type": row["event_type"],
+            "properties": json.loads(row["properties_json"]),
+        }
+        for row in batch.to_pylist()
+    ]
+
+
+async def _export_archived(
+    job: ExportJobDocument, index: int, out, day: datetime, pacer: RowPacer
+):
+    """Stream one archived day into the chunk file"""
+    # Segment columns are named like the CSV columns
+    table = await asyncio.to_thread(read_segment, day, CSV_COLUMNS, segment_filters(job.request))
+    table = await asyncio.to_thread(table.sort_by, "occurred_at")
+    for batch in table.to_batches(EXPORT_BATCH_SIZE):
+        docs = await asyncio.to_thread(_archived_docs, batch)
+        await _write_batch(job, index, out, docs, pacer)
+
+
+def build_filter(request: ExportRequest, start: datetime, end: datetime) -> dict:
+    query = {"occurred_at": {"$gte": start, "$lt": end}}
+    if request.event_type:
+        query["event_type"] = request.event_type
+    if request.user_id is not None:
+        query["user_id"] = request.user_id
+    return query
+
+
+async def _export_chunk(job: ExportJobDocument, index: int, pacer: RowPacer):
+    chunk = job.chunks[index]
+    request = job.request
+    path = Path(chunk["file"])
+
+    events = find_events(
+        build_filter(request, chunk["start"], chunk["end"]),
+        EXPORT_FIELDS,
+        sort_by_time=True,
+        batch_size=EXPORT_BATCH_SIZE
+    )
+
+    out = await asyncio.to_thread(_open, path, request.compression)
+    try:
+        if request.format == "csv":
+            await asyncio.to_thread(out.write, ",".join(CSV_COLUMNS) + "\n")
+
+        # Archived days first: they are older than anything still in MongoDB, except
+        # late events for those days, which follow with the hot rows
+        for day in cold_days(chunk["start"], chunk["end"]):
+            await _export_archived(job, index, out, day, pacer)
+
+        batch = []
+        async for doc in events:
+            batch.append(doc)
+            if len(batch) >= EXPORT_BATCH_SIZE:
+                await _write_batch(job, index, out, batch, pacer)
+                batch = []
+        if batch:
+            await _write_batch(job, index, out, batch, pacer)
+    finally:
+        await asyncio.to_thread(out.close)
+
+    await job.get_motor_collection().update_one(
+        {"_id": job.id},
+        {"$set": {f"chunks.{index}.status": "done", f"chunks.{index}.bytes": path.stat().st_size}}
+    )
+
+
+async def _write_batch(
+    job: ExportJobDocument, index: int, out, batch: List[dict], pacer: RowPacer
+):
+    text = _format_rows(batch, job.request.format)
+    await asyncio.to_thread(out.write, text)
+    await job.get_motor_collection().update_one(
+        {"_id": job.id},
+        {"$inc": {"rows_written": len(batch), f"chunks.{index}.rows": len(batch)}}
+    )
+    await pacer.wait(len(batch))
+
+
+async def _run(job: ExportJobDocument):
+    collection = job.get_motor_collection()
+    async with job_slots:
+        await collection.update_one(
+            {"_id": job.id}, {"$set": {"status": "running", "started_at": datetime.utcnow()}}
+        )
+        try:
+            Path(job.chunks[0]["file"]).parent.mkdir(parents=True, exist_ok=True)
+            pacer = RowPacer(EXPORT_MAX_ROWS_PER_SECOND)
+            chunk_slots = asyncio.Semaphore(EXPORT_PARALLEL_CHUNKS)
+
+            async def bounded(index):
+                async with chunk_slots:
+                    await _export_chunk(job, index, pacer)
+
+            # A failing chunk cancels its siblings instead of leaving them running
+            async with asyncio.TaskGroup() as chunks:
+                for i in range(len(job.chunks)):
+                    chunks.create_task(bounded(i))
+            update = {"status": "done"}
+        except asyncio.CancelledError:
+            update = {"status": "failed", "error": "cancelled"}
+            raise
+        except Exception as e:
+            if isinstance(e, ExceptionGroup):
+                e = e.exceptions[0]
+            logger.error(f"Export {job.job_id} failed: {e}")
+            update = {"status": "failed", "error": str(e)}
+        finally:
+            update["finished_at"] = datetime.utcnow()
+            await asyncio.shield(collection.update_one({"_id": job.id}, {"$set": update}))
+
+
+async def submit(request: ExportRequest) -> ExportJobDocument:
+    """Create an export job and start it in the background"""
+    start = parse_date(request.from_date)
+    end = parse_date(request.to_date) + timedelta(days=1)
+    if start >= end:
+        raise ValueError("from_date must be before to_date")
+    if request.compression == "zstd" and zstandard is None:
+        raise ValueError("zstd compression is not available, use gzip")
+
+    job_id = uuid4()
+    extension = f"{request.format}.{EXTENSIONS[request.compression]}"
+    ranges = split_range(start, end, EXPORT_PARALLEL_CHUNKS)
+    chunks = [
+        {
+            "start": chunk_start,
+            "end": chunk_end,
+            "file": str(Path(EXPORT_DIR) / str(job_id) / f"part-{i:04d}.{extension}"),
+            "status": "pending",
+            "rows": 0,
+        }
+        for i, (chunk_start, chunk_end) in enumerate(ranges)
+    ]
+
+    job = ExportJobDocument(job_id=job_id, request=request, chunks=chunks)
+    await job.insert()
+
+    task = asyncio.create_task(_run(job))
+    running_jobs.add(task)
+    task.add_done_callback(running_jobs.discard)
+    return job
+
+
+async def get_job(job_id: UUID) -> Optional[dict]:
+    """Job status and progress"""
+    job = await ExportJobDocument.find_one(ExportJobDocument.job_id == job_id)
+    if job is None:
+        return None
+
+    chunks_done = sum(1 for chunk in job.chunks if chunk.get("status") == "done")
+    elapsed = None
+    if job.started_at:
+        elapsed = ((job.finished_at or datetime.utcnow()) - job.started_at).total_seconds()
+
+    return {
+        "job_id": str(job.job_id),
+        "status": job.status,
+        "request": job.request.model_dump(),
+        "rows_written": job.rows_written,
+        "chunks_done": chunks_done,
+        "chunks_total": len(job.chunks),
+        "rows_per_second": round(job.rows_written / elapsed, 1) if elapsed else None,
+        "files": [
+            {
+                "file": chunk["file"],
+                "status": chunk.get("status"),
+                "rows": chunk.get("rows", 0),
+                "bytes": chunk.get("bytes"),
+            }
+            for chunk in job.chunks
+        ],
+        "error": job.error,
+        "created_at": job.created_at.isoformat(),
+        "finished_at": job.finished_at.isoformat() if job.finished_at else None,
+    }
+
+
+async def cancel_running():
+    """Stop export tasks at shutdown"""
+    for task in list(running_jobs):
+        task.cancel()
+    await asyncio.gather(*running_jobs, return_exceptions=True)
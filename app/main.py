@@ -1,41 +1,174 @@
 """FastAPI application"""
 from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse
+from starlette.datastructures import MutableHeaders
 from contextlib import asynccontextmanager
-from typing import List
+from typing import List, Optional
+from pymongo.errors import ExecutionTimeout
+from uuid import UUID
+import asyncio
 import logging
+import threading
 
-from models import EventInput, EventDocument
-from db import connect_db, disconnect_db, seed_csv
-from messaging import connect_queue, disconnect_queue, publish_event
+from models import EventInput, EventDocument, ExportRequest
+from db import connect_db, disconnect_db, ensure_indexes, seed_csv
+from messaging import connect_queue, disconnect_queue, publish_batch, messagemq
 from analytics import calculate_dau, calculate_top_events, calculate_retention, get_metrics
-from helpers import RateLimiter, to_uuid_str, from_uuid_str
-from config import RATE_LIMIT_REQUESTS, RATE_LIMIT_WINDOW
+from sketches import property_percentiles, calculate_revenue
+from cohorts import calculate_retention_matrix
+import cohorts
+import exports
+from profiling import StackSampler, profile_lock, slow_queries
+from helpers import RateLimiter
+from shared import LocalCounters, SharedRateLimiter, shared_state
+from wire import encode_event, encode_batch
+from scheduler import QueryScheduler, QueryQueueFull, ClientDisconnected, run_until_disconnected
+from config import (
+    RATE_LIMIT_REQUESTS, RATE_LIMIT_WINDOW, COLUMNAR_ENGINE, WIRE_BATCH_SIZE, API_WORKERS,
+    ANALYTICS_MAX_CONCURRENCY, ANALYTICS_MAX_QUEUED, PROFILE_TOKEN,
+    RETENTION_MATRIX_WINDOWS, RETENTION_MATRIX_REFRESH_SECONDS
+)
+from startup import startup
+import columnar
 
 logging.basicConfig(level=logging.WARNING, format='{"time":"%(asctime)s","msg":"%(message)s"}')
 logger = logging.getLogger(__name__)
 
+# Dependencies that must be up before the API takes traffic
+READY_COMPONENTS = ("database", "queue")
+
+
+async def bootstrap(primary: bool):
+    """Connect to MongoDB (retrying until it is reachable), then start what depends on it"""
+    await startup.retry("database", connect_db, True)
+    seed = None
+    if primary:
+        startup.spawn_retrying("indexes", ensure_indexes)
+        seed = startup.spawn_retrying("seed", seed_csv, startup.reporter("seed"))
+    if COLUMNAR_ENGINE:
+        startup.spawn("columnar", columnar.load, columnar.store)
+        startup.start(columnar.keep_fresh, columnar.store)
+    if seed is not None and RETENTION_MATRIX_REFRESH_SECONDS > 0:
+        # Closed days are never revisited, so they must not be closed over a partial seed
+        await seed
+        startup.start(cohorts.keep_current)
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    await connect_db()
-    await connect_queue()
-    await seed_csv()
+    # With several workers, once-per-server jobs run only in the primary one
+    primary = API_WORKERS <= 1 or shared_state.claim_primary()
+    startup.register("database", "queue")
+    startup.start(bootstrap, primary)
+    startup.spawn_retrying("queue", connect_queue)
     logger.warning("System initialized")
     yield
+    await startup.cancel()
+    await exports.cancel_running()
     await disconnect_queue()
     await disconnect_db()
+    shared_state.close()
 
 
 app = FastAPI(title="Event Analytics API", version="1.0.0", lifespan=lifespan)
-rate_limiter = RateLimiter(RATE_LIMIT_REQUESTS, RATE_LIMIT_WINDOW)
+# A single worker never opens the shared segment
+if API_WORKERS > 1:
+    rate_limiter = SharedRateLimiter(shared_state, RATE_LIMIT_REQUESTS, RATE_LIMIT_WINDOW)
+    request_counters = shared_state
+else:
+    rate_limiter = RateLimiter(RATE_LIMIT_REQUESTS, RATE_LIMIT_WINDOW)
+    request_counters = LocalCounters()
+query_scheduler = QueryScheduler(ANALYTICS_MAX_CONCURRENCY, ANALYTICS_MAX_QUEUED)
+
+
+def require_database():
+    """503 until the background connect has finished, like ingest while the queue is down"""
+    if not startup.is_ready("database"):
+        raise HTTPException(status_code=503, detail="Database is not connected yet")
+
+
+async def run_query(request: Request, func, *args):
+    """Run an analytics query through the scheduler"""
+    require_database()
+    try:
+        return await run_until_disconnected(request, query_scheduler.run(func, *args))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except QueryQueueFull as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except ExecutionTimeout:
+        raise HTTPException(status_code=504, detail="Query time budget exceeded")
+    except ClientDisconnected:
+        raise HTTPException(status_code=499, detail="Client closed request")
+
+
+class RateLimitMiddleware:
+    """Per-client rate limit and request counters
+
+    Pure ASGI rather than @app.middleware("http"): BaseHTTPMiddleware hands the endpoint a
+    receive channel that never reports http.disconnect, which run_query relies on.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        client = scope.get("client")
+        client_id = client[0] if client else "unknown"
+        request_counters.count("requests")
+        if not rate_limiter.allow_request(client_id):
+            request_counters.count("rate_limited")
+            response = JSONResponse({"detail": "Rate limit exceeded"}, status_code=429)
+            return await response(scope, receive, send)
+
+        async def send_counting(message):
+            if message["type"] == "http.response.start" and message["status"] >= 500:
+                request_counters.count("server_errors")
+            await send(message)
+
+        await self.app(scope, receive, send_counting)
+
+
+def profiling_allowed(request: Request) -> bool:
+    return bool(PROFILE_TOKEN) and request.headers.get("x-profile-token") == PROFILE_TOKEN
+
+
+class ProfileMiddleware:
+    """Sample the event loop while serving a request that carries the profile token"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        request = Request(scope)
+        if not profiling_allowed(request) or not profile_lock.acquire(blocking=False):
+            return await self.app(scope, receive, send)
+        try:
+            sampler = StackSampler(threading.get_ident()).start()
+
+            async def send_profiled(message):
+                # The profile covers the request up to the response headers
+                if message["type"] == "http.response.start" and not sampler.stopped:
+                    await asyncio.to_thread(sampler.stop)
+                    path = await asyncio.to_thread(sampler.dump, request.url.path)
+                    MutableHeaders(scope=message).append("X-Profile-File", str(path))
+                await send(message)
 
+            try:
+                await self.app(scope, receive, send_profiled)
+            finally:
+                if not sampler.stopped:
+                    await asyncio.to_thread(sampler.stop)
+        finally:
+            profile_lock.release()
 
-@app.middleware("http")
-async def rate_limit_middleware(request: Request, call_next):
-    client_id = request.client.host if request.client else "unknown"
-    if not rate_limiter.allow_request(client_id):
-        raise HTTPException(status_code=429, detail="Rate limit exceeded")
-    return await call_next(request)
+
+app.add_middleware(RateLimitMiddleware)
+app.add_middleware(ProfileMiddleware)
 
 
 @app.post("/events", status_code=202)
@@ -44,43 +177,103 @@ async def ingest_events(events: List[EventInput]):
     if not events or len(events) > 10000:
         raise HTTPException(status_code=400, detail="Invalid batch size")
 
-    for event in events:
-        event_dict = event.model_dump()
-        event_dict['event_id'] = to_uuid_str(event_dict['event_id'])
-        await publish_event(event_dict)
+    rows = [encode_event(event) for event in events]
+    try:
+        for i in range(0, len(rows), WIRE_BATCH_SIZE):
+            await publish_batch(encode_batch(rows[i:i + WIRE_BATCH_SIZE]))
+    except ConnectionError as e:
+        raise HTTPException(status_code=503, detail=str(e))
 
     return {"status": "accepted", "count": len(events)}
 
 
 @app.get("/stats/dau")
-async def get_dau(from_date: str, to_date: str):
+async def get_dau(request: Request, from_date: str, to_date: str):
     """Get Daily Active Users"""
-    try:
-        return await calculate_dau(from_date, to_date)
-    except ValueError as e:
-        raise HTTPException(status_code=400, detail=str(e))
+    return await run_query(request, calculate_dau, from_date, to_date)
 
 
 @app.get("/stats/top-events")
-async def get_top_events(from_date: str, to_date: str, limit: int = 10):
+async def get_top_events(request: Request, from_date: str, to_date: str, limit: int = 10):
     """Get top event types"""
     if limit < 1 or limit > 100:
         raise HTTPException(status_code=400, detail="Limit must be 1-100")
-    try:
-        return await calculate_top_events(from_date, to_date, limit)
-    except ValueError as e:
-        raise HTTPException(status_code=400, detail=str(e))
+    return await run_query(request, calculate_top_events, from_date, to_date, limit)
 
 
 @app.get("/stats/retention")
-async def get_retention(start_date: str, windows: int = 3):
+async def get_retention(request: Request, start_date: str, windows: int = 3):
     """Get cohort retention"""
     if windows < 1 or windows > 12:
         raise HTTPException(status_code=400, detail="Windows must be 1-12")
+    return await run_query(request, calculate_retention, start_date, windows)
+
+
+@app.get("/stats/retention-matrix")
+async def get_retention_matrix(request: Request, from_date: str, to_date: str, windows: int = 12):
+    """Get the retention triangle for a range of cohort days"""
+    if windows < 1 or windows > RETENTION_MATRIX_WINDOWS:
+        raise HTTPException(
+            status_code=400, detail=f"Windows must be 1-{RETENTION_MATRIX_WINDOWS}"
+        )
+    return await run_query(request, calculate_retention_matrix, from_date, to_date, windows)
+
+
+@app.get("/stats/property-percentiles")
+async def get_property_percentiles(
+    request: Request,
+    property: str,
+    from_date: str,
+    to_date: str,
+    percentiles: str = "50,90,99",
+    event_type: Optional[str] = None,
+    currency: Optional[str] = None
+):
+    """Get percentiles of a numeric event property"""
     try:
-        return await calculate_retention(start_date, windows)
+        values = tuple(float(p) for p in percentiles.split(","))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Percentiles must be numbers")
+    if not values or any(p < 0 or p > 100 for p in values):
+        raise HTTPException(status_code=400, detail="Percentiles must be 0-100")
+    return await run_query(
+        request, property_percentiles, property, from_date, to_date, values, event_type, currency
+    )
+
+
+@app.get("/stats/revenue")
+async def get_revenue(request: Request, from_date: str, to_date: str):
+    """Get daily revenue per currency"""
+    return await run_query(request, calculate_revenue, from_date, to_date)
+
+
+@app.post("/exports", status_code=202)
+async def create_export(request: ExportRequest):
+    """Submit a bulk export job"""
+    require_database()
+    try:
+        job = await exports.submit(request)
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
+    return {"job_id": str(job.job_id), "status": job.status}
+
+
+@app.get("/exports/{job_id}")
+async def get_export(job_id: UUID):
+    """Get export job progress"""
+    require_database()
+    job = await exports.get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Export job not found")
+    return job
+
+
+@app.get("/debug/slow-queries")
+async def get_slow_queries(request: Request):
+    """Recent analytics pipelines over SLOW_QUERY_MS"""
+    if not profiling_allowed(request):
+        raise HTTPException(status_code=404, detail="Not Found")
+    return {"data": list(slow_queries)}
 
 
 @app.get("/health")
@@ -89,7 +282,24 @@ async def health_check():
     return {"status": "healthy"}
 
 
+@app.get("/ready")
+async def readiness_check():
+    """Readiness probe"""
+    ready = startup.is_ready(*READY_COMPONENTS)
+    if messagemq.connection is not None and messagemq.connection.is_closed:
+        ready = False
+    return JSONResponse(
+        status_code=200 if ready else 503,
+        content={"status": "ready" if ready else "starting", "components": startup.snapshot()}
+    )
+
+
 @app.get("/metrics")
-async def metrics():
+async def metrics(request: Request):
     """System metrics"""
-    return await get_metrics()
\ No newline at end of file
+    result = await run_query(request, get_metrics)
+    return {
+        **result,
+        "analytics_scheduler": query_scheduler.stats(),
+        "api": {"workers": API_WORKERS, **request_counters.counters()}
+    }
\ No newline at end of file
@@ -12,6 +12,7 @@ class MessageMQ:
     connection: aio_pika.Connection = None
     channel: aio_pika.Channel = None
     events_queue: aio_pika.Message = None
+    dead_letters: aio_pika.Exchange = None
 
 
 messagemq = MessageMQ()
@@ -34,6 +35,7 @@ async def connect_queue():
 
             dlq = await messagemq.channel.declare_queue("events_dead_letter", durable=True)
             await dlq.bind(dlx, routing_key="events")
+            messagemq.dead_letters = dlx
 
             messagemq.events_queue = await messagemq.channel.declare_queue(
                 "events",
@@ -59,15 +61,32 @@ async def disconnect_queue():
         await messagemq.connection.close()
 
 
-async def publish_event(event_dict: dict):
-    """Publish event to queue"""
-    import msgpack
-    body = msgpack.packb(event_dict)
+async def publish_batch(body: bytes):
+    """Publish an encoded batch envelope to queue"""
+    from wire import CONTENT_TYPE
+    if messagemq.channel is None:
+        raise ConnectionError("Queue not connected")
 
     message = aio_pika.Message(
         body=body,
         delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
-        content_type="application/msgpack"
+        content_type=CONTENT_TYPE
     )
 
-    await messagemq.channel.default_exchange.publish(message, routing_key="events")
\ No newline at end of file
+    await messagemq.channel.default_exchange.publish(message, routing_key="events")
+
+
+async def publish_dead_letter(body: bytes, reason: str):
+    """Send an encoded batch envelope straight to the dead-letter queue"""
+    from wire import CONTENT_TYPE
+    if messagemq.dead_letters is None:
+        raise ConnectionError("Queue not connected")
+
+    message = aio_pika.Message(
+        body=body,
+        delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+        content_type=CONTENT_TYPE,
+        headers={"x-error": reason}
+    )
+
+    await messagemq.dead_letters.publish(message, routing_key="events")
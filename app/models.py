@@ -2,7 +2,7 @@
 from pydantic import BaseModel, Field, field_validator
 from beanie import Document
 from pymongo import IndexModel, ASCENDING
-from typing import Dict, Any
+from typing import Dict, Any, List, Literal, Optional
 from datetime import datetime
 from uuid import UUID
 
@@ -38,7 +38,7 @@ class EventInput(BaseModel):
         return v
 
 class EventDocument(Document):
-    """MongoDB document with indexes"""
+    """MongoDB document with indexes, in the long layout; events are written via storage"""
     event_id: UUID
     occurred_at: datetime
     user_id: int
@@ -56,4 +56,72 @@ class EventDocument(Document):
             IndexModel([("occurred_at", ASCENDING), ("user_id", ASCENDING)]),
             IndexModel([("occurred_at", ASCENDING), ("event_type", ASCENDING)]),
             IndexModel([("user_id", ASCENDING), ("occurred_at", ASCENDING)]),
+        ]
+
+class PropertySketchDocument(Document):
+    """Per-day quantile sketch of a numeric event property"""
+    day: datetime
+    event_type: str
+    property: str
+    currency: Optional[str] = None
+    samples: int = 0
+    sum: float = 0.0
+    min: float
+    max: float
+    zero: int = 0
+    positive: Dict[str, int] = Field(default_factory=dict)
+    negative: Dict[str, int] = Field(default_factory=dict)
+
+    class Settings:
+        name = "property_sketches"
+        indexes = [
+            IndexModel(
+                [("day", ASCENDING), ("event_type", ASCENDING),
+                 ("property", ASCENDING), ("currency", ASCENDING)],
+                unique=True
+            ),
+            IndexModel([("property", ASCENDING), ("day", ASCENDING)]),
+        ]
+
+
+class RetentionCohortDocument(Document):
+    """One row of the stored retention matrix"""
+    cohort: datetime
+    size: int = 0
+    retained: List[Optional[int]] = Field(default_factory=list)
+    updated_at: datetime = Field(default_factory=datetime.utcnow)
+
+    class Settings:
+        name = "retention_cohorts"
+        indexes = [
+            IndexModel([("cohort", ASCENDING)], unique=True),
+        ]
+
+
+class ExportRequest(BaseModel):
+    """Bulk export job input"""
+    from_date: str
+    to_date: str
+    event_type: Optional[str] = None
+    user_id: Optional[int] = None
+    format: Literal["ndjson", "csv"] = "ndjson"
+    compression: Literal["gzip", "zstd"] = "gzip"
+
+
+class ExportJobDocument(Document):
+    """Bulk export job state and progress"""
+    job_id: UUID
+    request: ExportRequest
+    status: str = "pending"
+    chunks: List[Dict[str, Any]] = Field(default_factory=list)
+    rows_written: int = 0
+    error: Optional[str] = None
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+
+    class Settings:
+        name = "export_jobs"
+        indexes = [
+            IndexModel([("job_id", ASCENDING)], unique=True),
         ]
\ No newline at end of file
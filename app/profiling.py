@@ -0,0 +1,183 @@
+"""Sampling profiler and slow-query log"""
+import asyncio
+import json
+import logging
+import sys
+import threading
+import time
+from collections import Counter, deque
+from datetime import datetime
+from pathlib import Path
+
+from config import PROFILE_DIR, PROFILE_INTERVAL_MS, SLOW_QUERY_MS, SLOW_QUERY_EXPLAIN_SECONDS
+
+logger = logging.getLogger(__name__)
+slow_logger = logging.getLogger("slow_queries")
+
+MAX_STACK_DEPTH = 128
+
+slow_queries = deque(maxlen=100)
+_explain_tasks = set()
+_explained = {}  # pipeline shape -> monotonic time of its last explain
+
+
+class StackSampler:
+    """Samples one thread's Python stack into folded flamegraph lines"""
+
+    def __init__(self, thread_id: int, interval_ms: int = PROFILE_INTERVAL_MS):
+        self.thread_id = thread_id
+        self.interval = interval_ms / 1000
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+
+    @staticmethod
+    def _fold(frame) -> str:
+        names = []
+        while frame is not None and len(names) < MAX_STACK_DEPTH:
+            code = frame.f_code
+            names.append(f"{code.co_name} ({Path(code.co_filename).name}:{code.co_firstlineno})")
+            frame = frame.f_back
+        return ";".join(reversed(names))
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.stacks[self._fold(frame)] += 1
+                self.samples += 1
+
+    def start(self) -> "StackSampler":
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    @property
+    def stopped(self) -> bool:
+        return self._stop.is_set()
+
+    def folded(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def dump(self, label: str) -> Path:
+        """Write folded stacks (flamegraph.pl / speedscope input) to PROFILE_DIR"""
+        safe = "".join(c if c.isalnum() or c in "-_" else "_" for c in label).strip("_")
+        name = f"{datetime.utcnow():%Y%m%dT%H%M%S%f}-{safe or 'profile'}.folded"
+        path = Path(PROFILE_DIR) / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(self.folded())
+        return path
+
+
+# One profiling session at a time bounds the overhead
+profile_lock = threading.Lock()
+
+
+def summarize_explain(explain: dict) -> dict:
+    """Plan stages and indexes used, from an explain document"""
+    stages, indexes = [], []
+
+    def walk(node):
+        if isinstance(node, dict):
+            if "stage" in node:
+                stages.append(node["stage"])
+            if "indexName" in node:
+                indexes.append(node["indexName"])
+            for key, value in node.items():
+                if key != "rejectedPlans":
+                    walk(value)
+        elif isinstance(node, list):
+            for item in node:
+                walk(item)
+
+    walk(explain)
+    return {
+        "stages": stages,
+        "indexes": sorted(set(indexes)),
+        "collection_scan": "COLLSCAN" in stages,
+    }
+
+
+def pipeline_shape(value) -> str:
+    """Pipeline with literals replaced by their type, so repeats of one query match"""
+    def shape(node):
+        if isinstance(node, dict):
+            return {key: shape(item) for key, item in node.items()}
+        if isinstance(node, list):
+            return [shape(item) for item in node]
+        return type(node).__name__
+
+    return json.dumps(shape(value), sort_keys=True)
+
+
+def _log_slow(entry: dict):
+    slow_queries.append(entry)
+    slow_logger.warning(json.dumps(entry, default=str))
+
+
+async def _explain_slow(collection, pipeline: list, entry: dict):
+    try:
+        explain = await collection.database.command({
+            "explain": {"aggregate": collection.name, "pipeline": pipeline, "cursor": {}},
+            "verbosity": "queryPlanner"
+        })
+        entry["explain"] = summarize_explain(explain)
+    except Exception as e:
+        entry["explain"] = {"error": str(e)}
+    _log_slow(entry)
+
+
+def _should_explain(pipeline: list) -> bool:
+    """One explain in flight, and each pipeline shape at most once per window"""
+    if _explain_tasks:
+        return False
+    now = time.monotonic()
+    for shape, explained_at in list(_explained.items()):
+        if now - explained_at >= SLOW_QUERY_EXPLAIN_SECONDS:
+            del _explained[shape]
+    shape = pipeline_shape(pipeline)
+    if shape in _explained:
+        return False
+    _explained[shape] = now
+    return True
+
+
+def record_query(collection, pipeline: list, started: float):
+    """Log a pipeline that ran over SLOW_QUERY_MS; explain runs off the request path"""
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    if SLOW_QUERY_MS <= 0 or elapsed_ms < SLOW_QUERY_MS:
+        return
+    entry = {
+        "time": datetime.utcnow().isoformat(),
+        "collection": collection.name,
+        "elapsed_ms": round(elapsed_ms, 1),
+        "pipeline": pipeline,
+    }
+    # Explains cost a planning round trip each; under load most slow queries are logged without
+    if not _should_explain(pipeline):
+        _log_slow(entry)
+        return
+    task = asyncio.create_task(_explain_slow(collection, pipeline, entry))
+    _explain_tasks.add(task)
+    task.add_done_callback(_explain_tasks.discard)
+
+
+async def profile_periodically(label: str, every_seconds: int, duration_seconds: int):
+    """Sample the event loop thread for a while at a fixed interval"""
+    thread_id = threading.get_ident()
+    while True:
+        await asyncio.sleep(every_seconds)
+        if not profile_lock.acquire(blocking=False):
+            continue
+        try:
+            sampler = StackSampler(thread_id).start()
+            await asyncio.sleep(duration_seconds)
+            await asyncio.to_thread(sampler.stop)
+            path = await asyncio.to_thread(sampler.dump, label)
+            logger.warning(f"Profile written to {path} ({sampler.samples} samples)")
+        finally:
+            profile_lock.release()
@@ -0,0 +1,112 @@
+"""Scheduling of heavy analytics queries"""
+import asyncio
+import logging
+from typing import Any, Callable, Dict, Hashable
+
+from fastapi import Request
+
+logger = logging.getLogger(__name__)
+
+DISCONNECT_POLL_SECONDS = 0.5
+
+
+class QueryQueueFull(Exception):
+    """Too many analytics queries waiting for a slot"""
+
+
+class ClientDisconnected(Exception):
+    """Client went away before its query finished"""
+
+
+class _Flight:
+    """One running query shared by every caller with the same key"""
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+class QueryScheduler:
+    """Single-flight coalescing over a bounded pool of concurrent queries"""
+
+    def __init__(self, max_concurrent: int, max_queued: int):
+        self.slots = asyncio.Semaphore(max_concurrent)
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.admitted = 0  # running or waiting for a slot
+        self.running = 0
+        self.coalesced = 0
+        self.flights: Dict[Hashable, _Flight] = {}
+
+    @property
+    def queued(self) -> int:
+        return max(self.admitted - self.running, 0)
+
+    async def _execute(self, func: Callable, *args) -> Any:
+        await self.slots.acquire()
+        self.running += 1
+        try:
+            return await func(*args)
+        finally:
+            self.running -= 1
+            self.slots.release()
+
+    async def run(self, func: Callable, *args) -> Any:
+        """Run func(*args), joining an identical in-flight call if there is one"""
+        key = (func.__name__, args)
+        flight = self.flights.get(key)
+        if flight is None:
+            # Admission is counted here, not when the task starts, so a burst is bounded too
+            if self.admitted >= self.max_concurrent + self.max_queued:
+                raise QueryQueueFull("Too many analytics queries in progress")
+            self.admitted += 1
+            flight = _Flight(asyncio.create_task(self._execute(func, *args)))
+            self.flights[key] = flight
+            flight.task.add_done_callback(lambda _: self._finish(key, flight))
+        else:
+            self.coalesced += 1
+
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task)
+        except asyncio.CancelledError:
+            # Last interested caller gone: stop the query and its cursor
+            if flight.waiters == 1:
+                self._forget(key, flight)
+                flight.task.cancel()
+            raise
+        finally:
+            flight.waiters -= 1
+
+    def _finish(self, key: Hashable, flight: _Flight):
+        self.admitted -= 1
+        self._forget(key, flight)
+
+    def _forget(self, key: Hashable, flight: _Flight):
+        if self.flights.get(key) is flight:
+            del self.flights[key]
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "running": self.running,
+            "queued": self.queued,
+            "in_flight": len(self.flights),
+            "coalesced_total": self.coalesced,
+        }
+
+
+async def run_until_disconnected(request: Request, awaitable) -> Any:
+    """Await a query, cancelling it if the HTTP client disconnects first"""
+    task = asyncio.ensure_future(awaitable)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=DISCONNECT_POLL_SECONDS)
+            if done:
+                return task.result()
+            if await request.is_disconnected():
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+                raise ClientDisconnected()
+    except asyncio.CancelledError:
+        task.cancel()
+        raise
@@ -0,0 +1,257 @@
+"""State shared by API worker processes through a memory-mapped file"""
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import time
+from typing import Dict, Optional
+
+from config import SHARED_STATE_PATH, RATE_LIMIT_SLOTS, RATE_LIMIT_STRIPES
+
+MAGIC = 0x45564E5453484D32  # "EVNTSHM2"
+MAX_WORKERS = 64
+COUNTERS = ("requests", "rate_limited", "server_errors")
+WAYS = 8  # rate-limit slots per hash bucket
+
+# Layout in int64 words: header, owner pid per counter row, one counter row per worker,
+# rate-limit slots
+HEADER = struct.Struct("<8q")
+MAGIC_WORD, OWNER_WORD, SLOTS_WORD, STRIPES_WORD = range(4)
+LAYOUT_WORDS = 4  # header words that must match for an existing file to be reused
+PIDS_BASE = HEADER.size // 8
+COUNTERS_BASE = PIDS_BASE + MAX_WORKERS
+SLOT_WORDS = 4  # client key, window number, current count, previous count
+KEY, WINDOW, CURRENT, PREVIOUS = range(SLOT_WORDS)
+
+
+def client_key(client_id: str) -> int:
+    """Stable non-zero 64-bit key (hash() differs between processes)"""
+    digest = hashlib.blake2b(client_id.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "little", signed=True) or 1
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class SharedState:
+    """Request counters and rate-limit buckets visible to every API worker"""
+
+    def __init__(
+        self,
+        path: str = SHARED_STATE_PATH,
+        slots: int = RATE_LIMIT_SLOTS,
+        stripes: int = RATE_LIMIT_STRIPES
+    ):
+        self.path = path
+        self.file = path
+        self.buckets = max(slots // WAYS, 1)
+        self.stripes = stripes
+        self.slots_base = COUNTERS_BASE + MAX_WORKERS * len(COUNTERS)
+        self.size = (self.slots_base + self.buckets * WAYS * SLOT_WORDS) * 8
+        # Byte-range locks past the end of the data, one per stripe plus init and primary
+        self.init_lock = self.size + stripes
+        self.primary_lock = self.init_lock + 1
+        self.fd: Optional[int] = None
+        self.mm: Optional[mmap.mmap] = None
+        self.words: Optional[memoryview] = None
+        self.row = 0
+        self.pid_word = 0
+
+    def _header(self):
+        return (MAGIC, os.getppid(), self.buckets * WAYS, self.stripes, 0, 0, 0, 0)
+
+    def _claim_row(self) -> bool:
+        """Take the row of a worker that exited, or an unused one (under the init lock)
+
+        A dead worker's counts stay in the row, so totals keep including them.
+        """
+        for row in range(MAX_WORKERS):
+            pid = self.words[PIDS_BASE + row]
+            if pid == 0 or not _alive(pid):
+                self.words[PIDS_BASE + row] = os.getpid()
+                self.pid_word = PIDS_BASE + row
+                self.row = COUNTERS_BASE + row * len(COUNTERS)
+                return True
+        return False
+
+    def _replace(self):
+        """Put a fresh segment in place without touching the one others may have mapped"""
+        tmp = f"{self.file}.{os.getpid()}.tmp"
+        fd = os.open(tmp, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            os.ftruncate(fd, self.size)
+            os.pwrite(fd, HEADER.pack(*self._header()), 0)
+        finally:
+            os.close(fd)
+        os.replace(tmp, self.file)
+
+    def _remove_stale(self):
+        """Delete segments of earlier server launches whose supervisor has exited"""
+        directory, prefix = os.path.split(self.path)
+        for name in os.listdir(directory or "."):
+            owner = name[len(prefix) + 1:]
+            if name.startswith(prefix + ".") and owner.isdigit() and not _alive(int(owner)):
+                try:
+                    os.unlink(os.path.join(directory, name))
+                except FileNotFoundError:
+                    pass
+
+    def open(self) -> "SharedState":
+        """Create or attach to this server launch's segment and claim a counter row
+
+        The file is named after the supervisor (the workers' parent), so processes of another
+        launch or a one-off process on the same host never share, and never reset, it.
+        """
+        if self.words is not None:
+            return self
+        self.file = f"{self.path}.{os.getppid()}"
+        while True:
+            fd = os.open(self.file, os.O_RDWR | os.O_CREAT, 0o600)
+            fcntl.lockf(fd, fcntl.LOCK_EX, 1, self.init_lock)
+            try:
+                if os.fstat(fd).st_ino != os.stat(self.file).st_ino:
+                    continue  # replaced while we waited for the lock
+                size = os.fstat(fd).st_size
+                if size == 0:
+                    # Just created: nobody can have it mapped yet
+                    os.ftruncate(fd, self.size)
+                    os.pwrite(fd, HEADER.pack(*self._header()), 0)
+                    self._remove_stale()
+                elif size != self.size or (
+                    HEADER.unpack(os.pread(fd, HEADER.size, 0))[:LAYOUT_WORDS]
+                    != self._header()[:LAYOUT_WORDS]
+                ):
+                    self._replace()
+                    continue
+                self.mm = mmap.mmap(fd, self.size)
+                self.words = memoryview(self.mm).cast("q")
+                claimed = self._claim_row()
+                break
+            finally:
+                fcntl.lockf(fd, fcntl.LOCK_UN, 1, self.init_lock)
+                if self.words is None:
+                    os.close(fd)
+        self.fd = fd
+        if not claimed:
+            self.close()
+            raise RuntimeError(f"All {MAX_WORKERS} counter rows in {self.file} are in use")
+        return self
+
+    def close(self):
+        if self.words is not None:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX, 1, self.init_lock)
+            if self.pid_word and self.words[self.pid_word] == os.getpid():
+                self.words[self.pid_word] = 0
+            fcntl.lockf(self.fd, fcntl.LOCK_UN, 1, self.init_lock)
+            self.words.release()
+            self.mm.close()
+            os.close(self.fd)
+            self.words = self.mm = self.fd = None
+
+    def claim_primary(self) -> bool:
+        """True in exactly one worker: the one that runs once-per-server jobs"""
+        self.open()
+        try:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, self.primary_lock)
+            return True
+        except OSError:
+            return False
+
+    def count(self, name: str, n: int = 1):
+        """Lock-free: each worker only writes its own row"""
+        self.open()
+        self.words[self.row + COUNTERS.index(name)] += n
+
+    def counters(self) -> Dict[str, int]:
+        """Counters summed over all workers"""
+        self.open()
+        totals = dict.fromkeys(COUNTERS, 0)
+        for row in range(MAX_WORKERS):
+            base = COUNTERS_BASE + row * len(COUNTERS)
+            for i, name in enumerate(COUNTERS):
+                totals[name] += self.words[base + i]
+        return totals
+
+    def _slot(self, bucket: int, key: int, window: int) -> int:
+        """Slot holding `key`, else a free one, else a live slot to share
+
+        Slots not hit in the last two windows are free. A live slot is never evicted, since
+        that would reset its client's count: when the bucket is full, the new client shares
+        the counter of the slot its key picks, and both are limited together until one frees.
+        """
+        words, free = self.words, None
+        first = self.slots_base + bucket * WAYS * SLOT_WORDS
+        for base in range(first, first + WAYS * SLOT_WORDS, SLOT_WORDS):
+            if words[base + KEY] == key:
+                return base
+            if free is None and words[base + WINDOW] < window - 1:
+                free = base
+        if free is not None:
+            return free
+        return first + (key // self.buckets) % WAYS * SLOT_WORDS
+
+    def hit(self, client_id: str, max_requests: int, window_seconds: int) -> bool:
+        """Sliding-window counter check and increment for one client"""
+        self.open()
+        key = client_key(client_id)
+        window, elapsed = divmod(time.time(), window_seconds)
+        window = int(window)
+        bucket = key % self.buckets
+        stripe = self.size + bucket % self.stripes
+
+        words = self.words
+        fcntl.lockf(self.fd, fcntl.LOCK_EX, 1, stripe)
+        try:
+            base = self._slot(bucket, key, window)
+            if words[base + WINDOW] < window - 1:
+                words[base + KEY] = key
+                words[base + CURRENT] = words[base + PREVIOUS] = 0
+            elif words[base + WINDOW] == window - 1:
+                words[base + PREVIOUS] = words[base + CURRENT]
+                words[base + CURRENT] = 0
+            words[base + WINDOW] = window
+
+            # The previous window counts for the part of it still inside the sliding window
+            weight = 1 - elapsed / window_seconds
+            if words[base + PREVIOUS] * weight + words[base + CURRENT] >= max_requests:
+                return False
+            words[base + CURRENT] += 1
+            return True
+        finally:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN, 1, stripe)
+
+
+class LocalCounters:
+    """Request counters of a single-worker server, kept in process"""
+
+    def __init__(self):
+        self.totals = dict.fromkeys(COUNTERS, 0)
+
+    def count(self, name: str, n: int = 1):
+        self.totals[name] += n
+
+    def counters(self) -> Dict[str, int]:
+        return dict(self.totals)
+
+
+class SharedRateLimiter:
+    """RateLimiter with its state in SharedState, so the limit holds across workers"""
+
+    def __init__(self, state: SharedState, max_requests: int, window_seconds: int):
+        self.state = state
+        self.max_requests = max_requests
+        self.window_seconds = window_seconds
+
+    def allow_request(self, client_id: str) -> bool:
+        return self.state.hit(client_id, self.max_requests, self.window_seconds)
+
+
+shared_state = SharedState()
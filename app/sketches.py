@@ -0,0 +1,277 @@
+"""Mergeable per-day quantile sketches for numeric event properties"""
+import asyncio
+import json
+import logging
+import math
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from pymongo import UpdateOne
+
+from models import PropertySketchDocument
+from storage import find_events
+from helpers import parse_date
+from config import (
+    SKETCH_PROPERTIES, SKETCH_RELATIVE_ACCURACY, REVENUE_EVENT_TYPE, REVENUE_PROPERTY
+)
+
+logger = logging.getLogger(__name__)
+
+# Log-bucketed sketch (DDSketch): every value within SKETCH_RELATIVE_ACCURACY of its bucket
+GAMMA = (1 + SKETCH_RELATIVE_ACCURACY) / (1 - SKETCH_RELATIVE_ACCURACY)
+LOG_GAMMA = math.log(GAMMA)
+
+SketchKey = Tuple[datetime, str, str, Optional[str]]
+
+
+def bucket_index(value: float) -> int:
+    return math.ceil(math.log(value) / LOG_GAMMA)
+
+
+def bucket_value(index: int) -> float:
+    return 2 * GAMMA ** index / (GAMMA + 1)
+
+
+class Sketch:
+    """Count, sum, min, max and log buckets of a value stream"""
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+        self.zero = 0
+        self.positive = Counter()
+        self.negative = Counter()
+
+    def add(self, value: float):
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        if value > 0:
+            self.positive[bucket_index(value)] += 1
+        elif value < 0:
+            self.negative[bucket_index(-value)] += 1
+        else:
+            self.zero += 1
+
+    def merge_document(self, doc: dict):
+        """Fold a stored sketch into this one"""
+        self.count += doc["samples"]
+        self.sum += doc["sum"]
+        self.min = min(self.min, doc["min"])
+        self.max = max(self.max, doc["max"])
+        self.zero += doc.get("zero", 0)
+        self.positive.update({int(k): v for k, v in doc.get("positive", {}).items()})
+        self.negative.update({int(k): v for k, v in doc.get("negative", {}).items()})
+
+    def quantile(self, q: float) -> Optional[float]:
+        if self.count == 0:
+            return None
+        rank = q * (self.count - 1)
+        seen = 0
+        for index in sorted(self.negative, reverse=True):
+            seen += self.negative[index]
+            if seen > rank:
+                return max(-bucket_value(index), self.min)
+        seen += self.zero
+        if seen > rank:
+            return 0.0
+        for index in sorted(self.positive):
+            seen += self.positive[index]
+            if seen > rank:
+                return min(bucket_value(index), self.max)
+        return self.max
+
+    def to_update(self) -> dict:
+        """$inc/$min/$max update that merges this sketch into a stored one"""
+        inc = {"samples": self.count, "sum": self.sum, "zero": self.zero}
+        inc.update({f"positive.{k}": v for k, v in self.positive.items()})
+        inc.update({f"negative.{k}": v for k, v in self.negative.items()})
+        return {"$inc": inc, "$min": {"min": self.min}, "$max": {"max": self.max}}
+
+
+def _utc_day(occurred_at: datetime) -> datetime:
+    if occurred_at.tzinfo is not None:
+        occurred_at = occurred_at.astimezone(timezone.utc).replace(tzinfo=None)
+    return datetime(occurred_at.year, occurred_at.month, occurred_at.day)
+
+
+def build_sketches(events: Iterable[Tuple[datetime, str, dict]]) -> Dict[SketchKey, Sketch]:
+    """Sketches per (day, event_type, property, currency) for configured properties"""
+    sketches = defaultdict(Sketch)
+    for occurred_at, event_type, properties in events:
+        day = None
+        for prop in SKETCH_PROPERTIES:
+            value = properties.get(prop)
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+            # NaN/Infinity parse from JSON but would poison the stored sum or the bucket index
+            if not math.isfinite(value):
+                continue
+            if day is None:
+                day = _utc_day(occurred_at)
+            sketches[(day, event_type, prop, properties.get("currency"))].add(value)
+    return sketches
+
+
+async def record_sketches(events: Iterable[Tuple[datetime, str, dict]], collection=None):
+    """Merge a batch of stored events into the per-day sketches"""
+    sketches = build_sketches(events)
+    if not sketches:
+        return
+    ops = [
+        UpdateOne(
+            {"day": day, "event_type": event_type, "property": prop, "currency": currency},
+            sketch.to_update(),
+            upsert=True
+        )
+        for (day, event_type, prop, currency), sketch in sketches.items()
+    ]
+    if collection is None:
+        collection = PropertySketchDocument.get_motor_collection()
+    await collection.bulk_write(ops, ordered=False)
+
+
+async def _stored_sketches(match: dict):
+    cursor = PropertySketchDocument.get_motor_collection().find(match, {"_id": 0})
+    async for doc in cursor:
+        yield doc
+
+
+async def property_percentiles(
+    prop: str, from_date: str, to_date: str, percentiles: List[float],
+    event_type: Optional[str] = None, currency: Optional[str] = None
+):
+    """Percentiles of a numeric property over a date range"""
+    start = parse_date(from_date)
+    end = parse_date(to_date) + timedelta(days=1)
+    if start > end:
+        raise ValueError("from_date must be before to_date")
+    if prop not in SKETCH_PROPERTIES:
+        raise ValueError(f"Property {prop} is not sketched")
+
+    match = {"property": prop, "day": {"$gte": start, "$lt": end}}
+    if event_type:
+        match["event_type"] = event_type
+    if currency:
+        match["currency"] = currency
+
+    merged = Sketch()
+    async for doc in _stored_sketches(match):
+        merged.merge_document(doc)
+
+    return {
+        "property": prop,
+        "from": from_date,
+        "to": to_date,
+        "count": merged.count,
+        "min": merged.min if merged.count else None,
+        "max": merged.max if merged.count else None,
+        "percentiles": {f"p{p:g}": merged.quantile(p / 100) for p in percentiles}
+    }
+
+
+async def calculate_revenue(from_date: str, to_date: str):
+    """Daily revenue per currency from sketch sums"""
+    start = parse_date(from_date)
+    end = parse_date(to_date) + timedelta(days=1)
+    if start > end:
+        raise ValueError("from_date must be before to_date")
+
+    match = {
+        "event_type": REVENUE_EVENT_TYPE,
+        "property": REVENUE_PROPERTY,
+        "day": {"$gte": start, "$lt": end}
+    }
+    daily = defaultdict(lambda: {"revenue": 0.0, "orders": 0})
+    totals = defaultdict(float)
+    async for doc in _stored_sketches(match):
+        row = daily[(doc["day"].strftime("%Y-%m-%d"), doc["currency"] or "")]
+        row["revenue"] += doc["sum"]
+        row["orders"] += doc["samples"]
+        totals[doc["currency"] or ""] += doc["sum"]
+
+    data = [
+        {
+            "date": date,
+            "currency": currency,
+            "revenue": round(row["revenue"], 2),
+            "orders": row["orders"]
+        }
+        for (date, currency), row in sorted(daily.items())
+    ]
+    return {
+        "from": from_date,
+        "to": to_date,
+        "data": data,
+        "totals": [
+            {"currency": currency, "revenue": round(total, 2)}
+            for currency, total in sorted(totals.items())
+        ]
+    }
+
+
+def _archived_events(path) -> List[Tuple[datetime, str, dict]]:
+    from archive import pq
+
+    table = pq.read_table(
+        path, columns=["occurred_at", "event_type", "properties_json"], memory_map=True
+    )
+    return list(zip(
+        table.column("occurred_at").to_pylist(),
+        table.column("event_type").to_pylist(),
+        map(json.loads, table.column("properties_json").to_pylist())
+    ))
+
+
+async def rebuild(batch_size: int = 5000) -> int:
+    """Recompute all sketches from the events collection and the archive
+
+    Sketches are built into a staging collection that then replaces the live one, so queries
+    never see it half-empty. Events a worker records while the rebuild runs are not in the
+    result; stop the workers first for an exact rebuild.
+    """
+    from archive import pq, ARCHIVE_DIR, SEGMENT_PREFIX
+
+    live = PropertySketchDocument.get_motor_collection()
+    staging = live.database[f"{live.name}_rebuild"]
+    await staging.drop()
+    await staging.create_indexes(PropertySketchDocument.Settings.indexes)
+    total = 0
+
+    if pq is not None and Path(ARCHIVE_DIR).is_dir():
+        for path in sorted(Path(ARCHIVE_DIR).glob(f"{SEGMENT_PREFIX}*.parquet")):
+            events = await asyncio.to_thread(_archived_events, path)
+            await record_sketches(events, staging)
+            total += len(events)
+
+    batch = []
+    async for doc in find_events({}, ["occurred_at", "event_type", "properties"]):
+        batch.append((doc["occurred_at"], doc["event_type"], doc.get("properties") or {}))
+        if len(batch) >= batch_size:
+            await record_sketches(batch, staging)
+            total += len(batch)
+            batch = []
+    await record_sketches(batch, staging)
+    await staging.rename(live.name, dropTarget=True)
+    return total + len(batch)
+
+
+async def main():
+    from db import connect_db, disconnect_db
+
+    logging.basicConfig(level=logging.WARNING, format='{"time":"%(asctime)s","msg":"%(message)s"}')
+    await connect_db()
+    try:
+        total = await rebuild()
+        logger.warning(f"Rebuilt property sketches from {total} events")
+    finally:
+        await disconnect_db()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
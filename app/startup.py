@@ -0,0 +1,100 @@
+"""Startup progress tracking"""
+import asyncio
+import logging
+import time
+from typing import Any, Callable, Dict, List
+
+from config import STARTUP_RETRY_MAX_SECONDS
+
+logger = logging.getLogger(__name__)
+
+PENDING = "pending"
+RUNNING = "running"
+READY = "ready"
+FAILED = "failed"
+
+
+class Startup:
+    """Status, timing and progress of each startup step"""
+
+    def __init__(self):
+        self.components: Dict[str, Dict[str, Any]] = {}
+        self.tasks: List[asyncio.Task] = []
+
+    def register(self, *names: str):
+        for name in names:
+            self.components[name] = {"status": PENDING}
+
+    async def run(self, name: str, func: Callable, *args):
+        """Run a startup step, recording its status and elapsed time"""
+        component = self.components.setdefault(name, {})
+        component["status"] = RUNNING
+        started = time.perf_counter()
+        try:
+            result = await func(*args)
+        except asyncio.CancelledError:
+            component["status"] = FAILED
+            component["error"] = "cancelled"
+            raise
+        except Exception as e:
+            component["status"] = FAILED
+            component["error"] = str(e)
+            logger.error(f"Startup step {name} failed: {e}")
+            return None
+        finally:
+            component["elapsed_ms"] = round((time.perf_counter() - started) * 1000, 1)
+
+        component["status"] = READY
+        logger.warning(f"Startup step {name} done in {component['elapsed_ms']} ms")
+        return result
+
+    async def retry(self, name: str, func: Callable, *args) -> bool:
+        """Run a startup step until it succeeds, backing off between attempts"""
+        delay = min(1, STARTUP_RETRY_MAX_SECONDS)
+        attempt = 0
+        while True:
+            attempt += 1
+            self.components.setdefault(name, {})["attempts"] = attempt
+            await self.run(name, func, *args)
+            if self.components[name]["status"] == READY:
+                return True
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, STARTUP_RETRY_MAX_SECONDS)
+
+    def start(self, func: Callable, *args) -> asyncio.Task:
+        """Background task cancelled at shutdown, not reported as a step"""
+        task = asyncio.create_task(func(*args))
+        self.tasks.append(task)
+        return task
+
+    def spawn(self, name: str, func: Callable, *args) -> asyncio.Task:
+        """Run a startup step in the background"""
+        self.components.setdefault(name, {"status": PENDING})
+        return self.start(self.run, name, func, *args)
+
+    def spawn_retrying(self, name: str, func: Callable, *args) -> asyncio.Task:
+        """Run a startup step in the background until it succeeds"""
+        self.components.setdefault(name, {"status": PENDING})
+        return self.start(self.retry, name, func, *args)
+
+    def reporter(self, name: str) -> Callable[..., None]:
+        """Progress callback for a long-running step"""
+        def report(**progress):
+            self.components.setdefault(name, {}).setdefault("progress", {}).update(progress)
+        return report
+
+    def is_ready(self, *names: str) -> bool:
+        return all(self.components.get(n, {}).get("status") == READY for n in names)
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        return {name: dict(component) for name, component in self.components.items()}
+
+    async def cancel(self):
+        """Cancel steps still running at shutdown"""
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+
+startup = Startup()
@@ -0,0 +1,236 @@
+"""Stored layout of events: long field names, or the opt-in compact layout"""
+import asyncio
+import logging
+from datetime import datetime
+from typing import Any, AsyncIterator, Dict, Iterable, List, Optional
+from uuid import UUID
+
+from bson.binary import Binary
+from pymongo import ASCENDING, IndexModel
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+from models import EventDocument
+from config import COMPACT_STORAGE, COMPACT_COLLECTION
+
+logger = logging.getLogger(__name__)
+
+LOGICAL_FIELDS = ["event_id", "occurred_at", "user_id", "event_type", "properties", "ingested_at"]
+COMPACT_FIELDS = {
+    "event_id": "e",
+    "occurred_at": "t",
+    "user_id": "u",
+    "event_type": "k",
+    "properties": "p",
+    "ingested_at": "i",
+}
+FIELDS = COMPACT_FIELDS if COMPACT_STORAGE else {name: name for name in LOGICAL_FIELDS}
+
+EVENT_ID = FIELDS["event_id"]
+OCCURRED_AT = FIELDS["occurred_at"]
+USER_ID = FIELDS["user_id"]
+EVENT_TYPE = FIELDS["event_type"]
+PROPERTIES = FIELDS["properties"]
+INGESTED_AT = FIELDS["ingested_at"]
+
+REGISTRY_COLLECTION = "event_types"
+UNKNOWN_CODE = -1
+DUPLICATE_KEY = 11000
+
+
+def events_collection(compact: bool = COMPACT_STORAGE):
+    """Motor collection holding events in the configured layout"""
+    collection = EventDocument.get_motor_collection()
+    return collection.database[COMPACT_COLLECTION] if compact else collection
+
+
+def index_models(compact: bool = COMPACT_STORAGE) -> List[IndexModel]:
+    """EventDocument's indexes, renamed to the stored field names"""
+    if not compact:
+        return EventDocument.Settings.indexes
+    return [
+        IndexModel(
+            [(COMPACT_FIELDS[name], order) for name, order in model.document["key"].items()],
+            unique=model.document.get("unique", False)
+        )
+        for model in EventDocument.Settings.indexes
+    ]
+
+
+class EventTypeRegistry:
+    """Dictionary encoding of event_type names to small ints"""
+
+    def __init__(self):
+        self.codes: Dict[str, int] = {}
+        self.names: Dict[int, str] = {}
+        self.lock = asyncio.Lock()
+
+    def _collection(self):
+        return EventDocument.get_motor_collection().database[REGISTRY_COLLECTION]
+
+    async def load(self):
+        async for doc in self._collection().find({}):
+            self.codes[doc["_id"]] = doc["code"]
+            self.names[doc["code"]] = doc["_id"]
+
+    async def ensure_indexes(self):
+        await self._collection().create_index([("code", ASCENDING)], unique=True)
+
+    async def _allocate(self, name: str) -> int:
+        collection = self._collection()
+        while True:
+            existing = await collection.find_one({"_id": name})
+            if existing:
+                return existing["code"]
+            last = await collection.find_one(sort=[("code", -1)])
+            code = last["code"] + 1 if last else 0
+            try:
+                await collection.insert_one({"_id": name, "code": code})
+                return code
+            except DuplicateKeyError:
+                # Another process took the name or the code; re-read and retry
+                continue
+
+    async def encode(self, name: str, create: bool = True, compact: bool = COMPACT_STORAGE) -> Any:
+        """Stored value for an event_type name"""
+        if not compact:
+            return name
+        code = self.codes.get(name)
+        if code is None:
+            if not create:
+                await self.load()
+                return self.codes.get(name, UNKNOWN_CODE)
+            async with self.lock:
+                code = self.codes.get(name)
+                if code is None:
+                    code = await self._allocate(name)
+                    self.codes[name] = code
+                    self.names[code] = name
+        return code
+
+    async def decode(self, value: Any) -> str:
+        """event_type name for a stored value"""
+        if not isinstance(value, int):
+            return value
+        if value not in self.names:
+            await self.load()
+        return self.names.get(value, str(value))
+
+
+event_types = EventTypeRegistry()
+
+
+async def to_stored(event: Dict[str, Any], compact: bool = COMPACT_STORAGE) -> Dict[str, Any]:
+    """Stored document for a logical event dict"""
+    names = COMPACT_FIELDS if compact else {name: name for name in LOGICAL_FIELDS}
+    event_id = event["event_id"]
+    if isinstance(event_id, UUID):
+        event_id = Binary.from_uuid(event_id)
+    return {
+        names["event_id"]: event_id,
+        names["occurred_at"]: event["occurred_at"],
+        names["user_id"]: event["user_id"],
+        names["event_type"]: await event_types.encode(event["event_type"], compact=compact),
+        names["properties"]: event.get("properties") or {},
+        names["ingested_at"]: event.get("ingested_at") or datetime.utcnow(),
+    }
+
+
+async def from_stored(doc: Dict[str, Any]) -> Dict[str, Any]:
+    """Logical event dict for a stored document"""
+    event = {name: doc.get(FIELDS[name]) for name in LOGICAL_FIELDS if FIELDS[name] in doc}
+    if "event_type" in event:
+        event["event_type"] = await event_types.decode(event["event_type"])
+    return event
+
+
+async def insert_events(events: Iterable[Dict[str, Any]]):
+    """insert_many of logical event dicts in the stored layout"""
+    docs = [await to_stored(event) for event in events]
+    if docs:
+        await events_collection().insert_many(docs, ordered=False)
+
+
+async def _stored_type(value: Any) -> Any:
+    if isinstance(value, list):
+        return [await event_types.encode(v, create=False) for v in value]
+    return await event_types.encode(value, create=False)
+
+
+async def stored_filter(query: Dict[str, Any]) -> Dict[str, Any]:
+    """Translate a filter on logical top-level fields to stored names and values"""
+    stored = {}
+    for name, condition in query.items():
+        if name == "event_type" and COMPACT_STORAGE:
+            if isinstance(condition, dict):
+                condition = {op: await _stored_type(v) for op, v in condition.items()}
+            else:
+                condition = await _stored_type(condition)
+        stored[FIELDS.get(name, name)] = condition
+    return stored
+
+
+async def find_events(
+    query: Dict[str, Any],
+    fields: Optional[List[str]] = None,
+    sort_by_time: bool = False,
+    batch_size: int = 1000
+) -> AsyncIterator[Dict[str, Any]]:
+    """Iterate events as logical dicts; `_id` is always included"""
+    projection = {FIELDS[name]: 1 for name in fields} if fields else None
+    cursor = events_collection().find(await stored_filter(query), projection, batch_size=batch_size)
+    if sort_by_time:
+        cursor = cursor.sort(OCCURRED_AT, 1).hint([(OCCURRED_AT, 1)])
+    async for doc in cursor:
+        event = await from_stored(doc)
+        event["_id"] = doc["_id"]
+        yield event
+
+
+async def migrate(batch_size: int = 5000) -> int:
+    """Copy events from the long layout into the compact collection (resumable)"""
+    source = events_collection(compact=False)
+    target = events_collection(compact=True)
+    await target.create_indexes(index_models(compact=True))
+    await event_types.ensure_indexes()
+
+    # _id is kept, so a rerun continues after the last copied document
+    last = await target.find_one(sort=[("_id", -1)], projection={"_id": 1})
+    query = {"_id": {"$gt": last["_id"]}} if last else {}
+
+    batch, total = [], 0
+    async for doc in source.find(query, batch_size=batch_size).sort("_id", 1):
+        stored = await to_stored(doc, compact=True)
+        stored["_id"] = doc["_id"]
+        batch.append(stored)
+        if len(batch) >= batch_size:
+            total += await _copy(target, batch)
+            batch = []
+    if batch:
+        total += await _copy(target, batch)
+    return total
+
+
+async def _copy(target, batch: List[dict]) -> int:
+    try:
+        await target.insert_many(batch, ordered=False)
+    except BulkWriteError as e:
+        if any(err["code"] != DUPLICATE_KEY for err in e.details["writeErrors"]):
+            raise
+    logger.warning(f"Migrated batch of {len(batch)} events")
+    return len(batch)
+
+
+async def main():
+    from db import connect_db, disconnect_db
+
+    logging.basicConfig(level=logging.WARNING, format='{"time":"%(asctime)s","msg":"%(message)s"}')
+    await connect_db(skip_indexes=True)
+    try:
+        total = await migrate()
+        logger.warning(f"Migration finished, copied {total} events to {COMPACT_COLLECTION}")
+    finally:
+        await disconnect_db()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
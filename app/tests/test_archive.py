@@ -0,0 +1,67 @@
+"""Test cold-tier segments"""
+import pytest
+from datetime import datetime
+from uuid import uuid4
+
+pytest.importorskip("pyarrow")
+
+import archive
+
+
+@pytest.fixture
+def archive_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(archive, "ARCHIVE_DIR", str(tmp_path))
+    return tmp_path
+
+
+def make_columns(day, rows):
+    return {
+        "event_id": [uuid4().bytes for _ in rows],
+        "occurred_at": [day.replace(hour=12) for _ in rows],
+        "user_id": [user_id for user_id, _ in rows],
+        "event_type": [event_type for _, event_type in rows],
+        "properties_json": ["{}" for _ in rows],
+        "ingested_at": [day for _ in rows],
+    }
+
+
+def test_segment_roundtrip(archive_dir):
+    """Archived days are found and read back per column"""
+    day = datetime(2025, 8, 1)
+    archive._write_segment(day, make_columns(day, [(1, "login"), (2, "login"), (1, "logout")]))
+
+    assert archive.cold_days(datetime(2025, 7, 31), datetime(2025, 8, 3)) == [day]
+    assert archive.archived_days() == [day]
+    assert archive.daily_users([day]) == {"2025-08-01": {1, 2}}
+    assert archive.event_type_counts([day]) == {"login": 2, "logout": 1}
+    assert archive.archived_stats() == {"events": 3, "oldest": "2025-08-01"}
+
+
+def test_segment_append_skips_duplicates(archive_dir):
+    """Re-archiving a day only adds events not already in the segment"""
+    day = datetime(2025, 8, 2)
+    columns = make_columns(day, [(1, "login")])
+    archive._write_segment(day, columns)
+
+    late = make_columns(day, [(3, "app_open")])
+    late = {key: columns[key] + late[key] for key in columns}
+    archive._write_segment(day, late)
+
+    assert archive.daily_users([day]) == {"2025-08-02": {1, 3}}
+    assert archive.archived_stats()["events"] == 2
+
+
+def test_type_counts_come_from_the_footer(archive_dir, monkeypatch):
+    """Per-type counts are stored in the segment footer and kept across appends"""
+    day = datetime(2025, 8, 3)
+    columns = make_columns(day, [(1, "login"), (2, "login")])
+    archive._write_segment(day, columns)
+    late = make_columns(day, [(3, "purchase")])
+    archive._write_segment(day, {key: columns[key] + late[key] for key in columns})
+
+    def no_scans(table):
+        raise AssertionError("event_type column scanned")
+
+    monkeypatch.setattr(archive, "_type_counts", no_scans)
+    assert archive.event_type_counts([day]) == {"login": 2, "purchase": 1}
+    assert archive.archived_stats()["events"] == 3
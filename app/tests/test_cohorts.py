@@ -0,0 +1,98 @@
+"""Test the stored retention matrix"""
+from datetime import datetime, timedelta
+
+import pytest
+
+import cohorts
+from cohorts import close_days, recompute, retention_row
+
+DAY = timedelta(days=1)
+START = datetime(2025, 8, 1)
+
+
+class MemoryCohorts:
+    """The few collection operations the matrix uses, in memory"""
+
+    def __init__(self):
+        self.docs = {}
+
+    async def update_one(self, query, update, upsert=False):
+        self.docs[query["cohort"]] = {"_id": query["cohort"], "cohort": query["cohort"],
+                                      **update["$set"]}
+
+    def find(self, query, projection=None):
+        window = query["cohort"]
+
+        async def docs():
+            for cohort in sorted(self.docs):
+                doc = self.docs[cohort]
+                if window["$gte"] <= cohort < window["$lt"] and doc["size"] > 0:
+                    yield doc
+        return docs()
+
+    async def find_one(self, query, projection=None, sort=None):
+        return self.docs[max(self.docs)] if self.docs else None
+
+    async def bulk_write(self, ops, ordered=True):
+        for op in ops:
+            doc = self.docs[op._filter["_id"]]
+            for key, value in op._doc["$set"].items():
+                if key.startswith("retained."):
+                    index = int(key.split(".")[1])
+                    doc["retained"] += [None] * (index + 1 - len(doc["retained"]))
+                    doc["retained"][index] = value
+
+
+@pytest.fixture
+def matrix(monkeypatch):
+    collection = MemoryCohorts()
+    users = {START + i * DAY: set(day_users) for i, day_users in enumerate(
+        [{1, 2, 3, 4}, {1, 2, 5}, {1, 5, 6}, {2, 6}]
+    )}
+
+    async def day_users(day):
+        return users.get(day, set())
+
+    async def first_day():
+        return START
+
+    monkeypatch.setattr(cohorts, "_collection", lambda: collection)
+    monkeypatch.setattr(cohorts, "day_users", day_users)
+    monkeypatch.setattr(cohorts, "_first_day", first_day)
+    monkeypatch.setattr(cohorts, "RETENTION_MATRIX_WINDOWS", 2)
+    return collection, users
+
+
+async def test_close_days_builds_triangle(matrix):
+    """Closed days fill each cohort's windows up to RETENTION_MATRIX_WINDOWS"""
+    collection, _ = matrix
+    assert await close_days(now=START + 4 * DAY + timedelta(hours=3)) == 4
+
+    assert [(d["size"], d["retained"]) for d in collection.docs.values()] == [
+        (4, [2, 1]), (3, [2, 1]), (3, [1]), (2, [])
+    ]
+    assert await close_days(now=START + 4 * DAY) == 0
+
+
+async def test_recompute_picks_up_late_events(matrix):
+    """Recomputing a day refreshes its cohort and the windows that land on it"""
+    collection, users = matrix
+    await close_days(now=START + 4 * DAY)
+
+    users[START + DAY] |= {3, 7}
+    await recompute("2025-08-02", "2025-08-02", now=START + 4 * DAY)
+
+    assert [(d["size"], d["retained"]) for d in collection.docs.values()] == [
+        (4, [3, 1]), (5, [2, 1]), (3, [1]), (2, [])
+    ]
+
+
+def test_retention_row_limits_windows():
+    """Rows are cut to the requested windows and skip missing cells"""
+    doc = {"cohort": START, "size": 4, "retained": [2, None, 1]}
+    row = retention_row(doc, 2)
+
+    assert row["cohort_date"] == "2025-08-01"
+    assert row["retention"] == [
+        {"day": 1, "date": "2025-08-02", "retained_users": 2, "retention_rate": 50.0}
+    ]
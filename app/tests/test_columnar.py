@@ -0,0 +1,75 @@
+"""Test columnar analytics engine"""
+import asyncio
+
+import pytest
+from datetime import datetime
+
+pytest.importorskip("numpy")
+
+import columnar
+from columnar import ColumnarStore, MS_PER_DAY, day_offset, keep_fresh
+
+
+def ms(day: datetime, hour: int = 12) -> int:
+    return day_offset(day) * MS_PER_DAY + hour * 3_600_000
+
+
+@pytest.fixture
+def store():
+    target = ColumnarStore()
+    d1, d2, d3 = datetime(2025, 8, 1), datetime(2025, 8, 2), datetime(2025, 8, 3)
+    target.append(
+        [1, 1, 2, 3, 1, 2, 4, 1],
+        [ms(d1), ms(d1, 13), ms(d1), ms(d1), ms(d2), ms(d2), ms(d2), ms(d3)],
+        ["login", "view_item", "login", "login", "app_open", "app_open", "login", "logout"]
+    )
+    return target
+
+
+async def test_dau(store):
+    """Distinct users are counted once per day"""
+    assert await store.dau(datetime(2025, 8, 1), datetime(2025, 8, 3)) == {
+        "2025-08-01": 3,
+        "2025-08-02": 3,
+    }
+
+
+async def test_top_events(store):
+    """Event types are ranked by count within the range"""
+    assert await store.top_events(datetime(2025, 8, 1), datetime(2025, 8, 4), 2) == [
+        ("login", 4),
+        ("app_open", 2),
+    ]
+
+
+async def test_retention(store):
+    """Retained users are intersected with the cohort"""
+    assert await store.retention(datetime(2025, 8, 1), 3) == (3, [2, 1, 0])
+
+
+async def test_buffers_grow(store):
+    """Appends beyond the initial capacity keep earlier rows"""
+    day = datetime(2025, 8, 5)
+    store.append([5] * 150_000, [ms(day)] * 150_000, ["login"] * 150_000)
+    assert store.size == 150_008
+    assert await store.dau(day, datetime(2025, 8, 6)) == {"2025-08-05": 1}
+    assert await store.retention(datetime(2025, 8, 1), 1) == (3, [2])
+
+
+async def test_failed_refresh_unloads_snapshot(store, monkeypatch):
+    """A refresh that cannot append stops the stale snapshot from serving queries"""
+    with pytest.raises(ValueError):
+        store.append([2**31], [ms(datetime(2025, 8, 4))], ["login"])
+
+    async def refresh(target):
+        target.append([2**31], [ms(datetime(2025, 8, 4))], ["login"])
+
+    monkeypatch.setattr(columnar, "refresh", refresh)
+    monkeypatch.setattr(columnar, "COLUMNAR_REFRESH_SECONDS", 0)
+    store.loaded = True
+    task = asyncio.create_task(keep_fresh(store))
+    for _ in range(10):
+        await asyncio.sleep(0)
+    task.cancel()
+
+    assert not store.loaded
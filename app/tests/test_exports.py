@@ -0,0 +1,133 @@
+"""Test export job formatting and chunking"""
+import asyncio
+import csv
+import gzip
+import io
+import json
+from datetime import datetime
+from types import SimpleNamespace
+from uuid import UUID
+
+import pytest
+from bson.binary import Binary
+
+import archive
+import exports
+from models import ExportRequest
+from exports import split_range, _format_rows
+
+
+DOC = {
+    "event_id": Binary.from_uuid(UUID("25a4b866-040b-466f-945c-148e4720f511")),
+    "occurred_at": datetime(2025, 8, 21, 3, 52, 34),
+    "user_id": 1,
+    "event_type": "view_item",
+    "properties": {"price": 118.64, "currency": "USD"},
+}
+
+
+def test_split_range_covers_whole_days():
+    """Chunks are contiguous, whole-day and cover the range exactly"""
+    start, end = datetime(2025, 8, 1), datetime(2025, 9, 1)
+    chunks = split_range(start, end, 4)
+
+    assert len(chunks) == 4
+    assert chunks[0][0] == start and chunks[-1][1] == end
+    assert all(a[1] == b[0] for a, b in zip(chunks, chunks[1:]))
+    assert split_range(start, datetime(2025, 8, 2), 4) == [(start, datetime(2025, 8, 2))]
+
+
+def test_csv_rows_match_sample_layout():
+    """CSV rows use the data/events_sample.csv columns and parse back"""
+    row = next(csv.reader(io.StringIO(_format_rows([DOC], "csv"))))
+
+    assert row[0] == "25a4b866-040b-466f-945c-148e4720f511"
+    assert datetime.fromisoformat(row[1]).isoformat() == "2025-08-21T03:52:34+00:00"
+    assert row[2:4] == ["1", "view_item"]
+    assert json.loads(row[4]) == DOC["properties"]
+
+
+def test_ndjson_rows():
+    """NDJSON rows carry the same columns as keys"""
+    line = json.loads(_format_rows([DOC], "ndjson"))
+    assert set(line) == {"event_id", "occurred_at", "user_id", "event_type", "properties_json"}
+    assert line["user_id"] == 1
+
+
+class MemoryJobs:
+    def __init__(self):
+        self.updates = []
+
+    async def update_one(self, query, update):
+        self.updates.append(update)
+
+
+def make_job(tmp_path, chunks, **request):
+    jobs = MemoryJobs()
+    return SimpleNamespace(
+        id=1,
+        job_id="job",
+        request=ExportRequest(from_date="2025-08-01", to_date="2025-08-02", **request),
+        chunks=[
+            {"start": start, "end": end, "file": str(tmp_path / f"part-{i}.ndjson.gz")}
+            for i, (start, end) in enumerate(chunks)
+        ],
+        get_motor_collection=lambda: jobs,
+    ), jobs
+
+
+async def test_chunk_includes_archived_days(tmp_path, monkeypatch):
+    """Archived days are streamed into the chunk file along with MongoDB rows"""
+    pytest.importorskip("pyarrow")
+    monkeypatch.setattr(archive, "ARCHIVE_DIR", str(tmp_path))
+    day = datetime(2025, 8, 1)
+    event_id = UUID("25a4b866-040b-466f-945c-148e4720f511")
+    archive._write_segment(day, {
+        "event_id": [event_id.bytes, UUID(int=1).bytes],
+        "occurred_at": [day.replace(hour=3), day.replace(hour=2)],
+        "user_id": [1, 2],
+        "event_type": ["view_item", "login"],
+        "properties_json": ['{"price":1.5}', "{}"],
+        "ingested_at": [day, day],
+    })
+
+    async def hot_events(query, fields, sort_by_time, batch_size):
+        yield {**DOC, "occurred_at": datetime(2025, 8, 2, 1)}
+
+    monkeypatch.setattr(exports, "find_events", hot_events)
+    job, _ = make_job(tmp_path, [(day, datetime(2025, 8, 3))], event_type="view_item")
+    await exports._export_chunk(job, 0, exports.RowPacer(0))
+
+    with gzip.open(job.chunks[0]["file"], "rt") as f:
+        rows = [json.loads(line) for line in f]
+    assert [row["occurred_at"] for row in rows] == [
+        "2025-08-01T03:00:00+00:00", "2025-08-02T01:00:00+00:00"
+    ]
+    assert rows[0]["event_id"] == str(event_id)
+    assert json.loads(rows[0]["properties_json"]) == {"price": 1.5}
+
+
+async def test_failed_chunk_cancels_the_others(tmp_path, monkeypatch):
+    """One failing chunk stops the job and its running siblings"""
+    cancelled = asyncio.Event()
+
+    async def export_chunk(job, index, pacer):
+        if index == 0:
+            await asyncio.sleep(0)
+            raise OSError("disk full")
+        try:
+            await asyncio.sleep(30)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+
+    monkeypatch.setattr(exports, "_export_chunk", export_chunk)
+    monkeypatch.setattr(exports, "EXPORT_PARALLEL_CHUNKS", 2)
+    day = datetime(2025, 8, 1)
+    job, jobs = make_job(tmp_path, [(day, day), (day, day)])
+
+    await asyncio.wait_for(exports._run(job), timeout=5)
+
+    assert cancelled.is_set()
+    assert jobs.updates[-1]["$set"]["status"] == "failed"
+    assert jobs.updates[-1]["$set"]["error"] == "disk full"
@@ -8,12 +8,14 @@ from unittest.mock import AsyncMock, patch
 from main import app
 from db import connect_db, disconnect_db
 from models import EventDocument
+from startup import startup
 
 
 @pytest.fixture(scope="function")
 async def setup():
     """Setup and teardown for each test"""
-    await connect_db()
+    # Through the startup tracker, so the API sees the database as ready
+    await startup.run("database", connect_db)
 
     # Clean up test data before each test
     await EventDocument.find(
@@ -34,7 +36,7 @@ async def setup():
 async def test_event_ingestion(setup):
     """Test event ingestion endpoint"""
     # Mock the message queue publishing
-    with patch('main.publish_event', new_callable=AsyncMock) as mock_publish:
+    with patch('main.publish_batch', new_callable=AsyncMock) as mock_publish:
         async with AsyncClient(app=app, base_url="http://test") as client:
             response = await client.post("/events", json=[{
                 "event_id": str(uuid4()),
@@ -91,4 +93,4 @@ async def test_health_check(setup):
     async with AsyncClient(app=app, base_url="http://test") as client:
         response = await client.get("/health")
         assert response.status_code == 200
-        assert response.json()["status"] == "healthy"
\ No newline at end of file
+        assert response.json()["status"] == "healthy"
@@ -0,0 +1,84 @@
+"""Test sampling profiler and explain summaries"""
+import asyncio
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from types import SimpleNamespace
+
+import profiling
+from profiling import StackSampler, record_query, summarize_explain
+
+
+def busy_loop(seconds: float):
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        pass
+
+
+def test_sampler_folds_stacks(tmp_path, monkeypatch):
+    """Samples are folded root-first and written one stack per line"""
+    monkeypatch.setattr("profiling.PROFILE_DIR", str(tmp_path))
+    sampler = StackSampler(threading.get_ident(), interval_ms=1).start()
+    busy_loop(0.1)
+    sampler.stop()
+
+    assert sampler.samples > 0
+    assert any("busy_loop" in stack.split(";")[-1] for stack in sampler.stacks)
+
+    path = sampler.dump("/stats/retention")
+    assert path.parent == tmp_path
+    assert path.name.endswith("-stats_retention.folded")
+    stack, count = path.read_text().splitlines()[0].rsplit(" ", 1)
+    assert int(count) > 0
+
+
+def test_summarize_explain():
+    """Winning plan stages and index names are collected, rejected plans skipped"""
+    explain = {
+        "stages": [{
+            "$cursor": {"queryPlanner": {
+                "winningPlan": {
+                    "stage": "FETCH",
+                    "inputStage": {"stage": "IXSCAN", "indexName": "occurred_at_1"}
+                },
+                "rejectedPlans": [{"stage": "COLLSCAN"}]
+            }}
+        }, {"$group": {}}]
+    }
+    assert summarize_explain(explain) == {
+        "stages": ["FETCH", "IXSCAN"],
+        "indexes": ["occurred_at_1"],
+        "collection_scan": False,
+    }
+
+
+async def test_slow_query_explains_are_bounded(monkeypatch):
+    """One explain runs at a time and a pipeline shape is explained once per window"""
+    monkeypatch.setattr(profiling, "slow_queries", deque(maxlen=100))
+    monkeypatch.setattr(profiling, "_explained", {})
+    release, explained = asyncio.Event(), []
+
+    async def command(cmd):
+        explained.append(cmd["explain"]["pipeline"])
+        await release.wait()
+        return {"stage": "COLLSCAN"}
+
+    collection = SimpleNamespace(name="events", database=SimpleNamespace(command=command))
+
+    def pipeline(day, field="occurred_at"):
+        return [{"$match": {field: {"$gte": datetime(2025, 8, day)}}}]
+
+    slow = time.perf_counter() - 1
+    record_query(collection, pipeline(1), slow)
+    await asyncio.sleep(0)
+    record_query(collection, pipeline(2, "user_id"), slow)  # one already in flight
+    release.set()
+    await asyncio.gather(*profiling._explain_tasks)
+    record_query(collection, pipeline(3), slow)  # same shape as the first
+    record_query(collection, pipeline(4, "user_id"), slow)
+    await asyncio.gather(*profiling._explain_tasks)
+
+    assert explained == [pipeline(1), pipeline(4, "user_id")]
+    assert len(profiling.slow_queries) == 4
+    assert sum("explain" in entry for entry in profiling.slow_queries) == 2
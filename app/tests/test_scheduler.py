@@ -0,0 +1,195 @@
+"""Test analytics query scheduler"""
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from scheduler import QueryScheduler, QueryQueueFull
+from startup import Startup, READY
+
+
+@pytest.mark.asyncio
+async def test_identical_queries_coalesce():
+    """Concurrent identical calls share one execution"""
+    scheduler = QueryScheduler(max_concurrent=2, max_queued=10)
+    calls = []
+
+    async def query(day):
+        calls.append(day)
+        await asyncio.sleep(0.01)
+        return {"day": day}
+
+    results = await asyncio.gather(*(scheduler.run(query, "2025-08-01") for _ in range(5)))
+
+    assert calls == ["2025-08-01"]
+    assert all(r == {"day": "2025-08-01"} for r in results)
+    assert scheduler.stats()["coalesced_total"] == 4
+    assert scheduler.flights == {}
+
+
+@pytest.mark.asyncio
+async def test_concurrency_is_bounded():
+    """No more than max_concurrent queries run at once, the rest queue"""
+    scheduler = QueryScheduler(max_concurrent=2, max_queued=1)
+    release = asyncio.Event()
+    peak = 0
+
+    async def query(n):
+        nonlocal peak
+        peak = max(peak, scheduler.running)
+        await release.wait()
+        return n
+
+    tasks = [asyncio.create_task(scheduler.run(query, n)) for n in range(3)]
+    await asyncio.sleep(0)
+    await asyncio.sleep(0)
+
+    with pytest.raises(QueryQueueFull):
+        await scheduler.run(query, 99)
+
+    release.set()
+    assert await asyncio.gather(*tasks) == [0, 1, 2]
+    assert peak == 2
+
+
+@pytest.mark.asyncio
+async def test_burst_is_bounded():
+    """Calls made before any query task starts still count against the queue"""
+    scheduler = QueryScheduler(max_concurrent=1, max_queued=2)
+
+    async def query(n):
+        await asyncio.sleep(0.01)
+        return n
+
+    results = await asyncio.gather(
+        *(scheduler.run(query, n) for n in range(20)), return_exceptions=True
+    )
+
+    assert results[:3] == [0, 1, 2]
+    assert all(isinstance(r, QueryQueueFull) for r in results[3:])
+    assert scheduler.stats()["queued"] == 0
+
+
+@pytest.mark.asyncio
+async def test_last_waiter_cancels_query():
+    """Query is cancelled once every caller has gone away"""
+    scheduler = QueryScheduler(max_concurrent=1, max_queued=10)
+    cancelled = asyncio.Event()
+
+    async def query():
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+
+    first = asyncio.create_task(scheduler.run(query))
+    second = asyncio.create_task(scheduler.run(query))
+    await asyncio.sleep(0.01)
+
+    first.cancel()
+    await asyncio.sleep(0.01)
+    assert not cancelled.is_set()
+
+    second.cancel()
+    await asyncio.wait_for(cancelled.wait(), 1)
+    assert scheduler.flights == {}
+
+
+@pytest.mark.asyncio
+async def test_disconnect_cancels_query_through_app(monkeypatch):
+    """A client disconnect reaches the endpoint through the middlewares and cancels the query"""
+    import main
+    import scheduler
+
+    monkeypatch.setattr(scheduler, "DISCONNECT_POLL_SECONDS", 0.01)
+    started, cancelled = asyncio.Event(), asyncio.Event()
+
+    async def calculate_dau(from_date, to_date):
+        started.set()
+        try:
+            await asyncio.sleep(30)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+
+    monkeypatch.setattr(main, "calculate_dau", calculate_dau)
+    tracker = Startup()
+    tracker.components["database"] = {"status": READY}
+    monkeypatch.setattr(main, "startup", tracker)
+
+    async def receive():
+        await started.wait()
+        return {"type": "http.disconnect"}
+
+    sent = []
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET",
+        "scheme": "http", "path": "/stats/dau", "raw_path": b"/stats/dau",
+        "query_string": b"from_date=2025-08-01&to_date=2025-08-02", "root_path": "",
+        "headers": [(b"host", b"test")], "client": ("127.0.0.1", 1234), "server": ("test", 80),
+    }
+    await asyncio.wait_for(main.app(scope, receive, send), timeout=5)
+
+    assert cancelled.is_set()
+    assert sent[0]["status"] == 499
+
+
+class SlowCursor:
+    """Aggregate cursor whose first batch never arrives"""
+
+    def __init__(self):
+        self.closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        await asyncio.sleep(30)
+
+    async def close(self):
+        self.closed = True
+
+
+@pytest.mark.asyncio
+async def test_cancelled_aggregate_is_killed_on_server(monkeypatch):
+    """Cancelling a query kills its tagged aggregate on the server, not just the task"""
+    import analytics
+
+    cursor, commands = SlowCursor(), []
+
+    class Admin:
+        def aggregate(self, pipeline):
+            comment = pipeline[1]["$match"]["command.comment"]
+            ops = [{"opid": 7, "command": {"comment": comment}}]
+            return SimpleNamespace(to_list=lambda length: asyncio.sleep(0, ops))
+
+        async def command(self, name, **kwargs):
+            commands.append((name, kwargs))
+
+    class Collection:
+        name = "events"
+        database = SimpleNamespace(client=SimpleNamespace(admin=Admin()))
+
+        def aggregate(self, pipeline, maxTimeMS, comment):
+            assert comment.startswith("analytics:")
+            return cursor
+
+    monkeypatch.setattr(analytics, "events_collection", Collection)
+    monkeypatch.setattr(analytics, "record_query", lambda *args: None)
+
+    async def consume():
+        return [doc async for doc in analytics._aggregate([{"$group": {"_id": None}}])]
+
+    task = asyncio.create_task(consume())
+    await asyncio.sleep(0.01)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+
+    assert commands == [("killOp", {"op": 7})]
+    assert cursor.closed
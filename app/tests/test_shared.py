@@ -0,0 +1,132 @@
+"""Test state shared between API workers"""
+import multiprocessing
+
+import pytest
+
+import shared
+from shared import SharedState, SharedRateLimiter
+
+
+@pytest.fixture
+def state_path(tmp_path):
+    return str(tmp_path / "api.state")
+
+
+def _other_worker(path, results):
+    state = SharedState(path, slots=64, stripes=4).open()
+    results.put((
+        SharedRateLimiter(state, 3, 60).allow_request("10.0.0.1"),
+        state.claim_primary(),
+    ))
+    state.count("requests", 5)
+    state.close()
+
+
+def test_limit_holds_across_processes(state_path, monkeypatch):
+    """A second process sees the same client's hits, and only one process is primary"""
+    # uvicorn workers are siblings; here the second process is a child
+    monkeypatch.setattr(shared.os, "getppid", lambda: 1)
+    state = SharedState(state_path, slots=64, stripes=4).open()
+    limiter = SharedRateLimiter(state, 3, 60)
+    assert limiter.allow_request("10.0.0.1")
+    assert limiter.allow_request("10.0.0.1")
+    assert state.claim_primary()
+
+    results = multiprocessing.get_context("fork").Queue()
+    process = multiprocessing.get_context("fork").Process(
+        target=_other_worker, args=(state_path, results)
+    )
+    process.start()
+    process.join()
+
+    assert results.get() == (True, False)
+    assert not limiter.allow_request("10.0.0.1")
+    assert limiter.allow_request("10.0.0.2")
+    assert state.counters()["requests"] == 5
+    state.close()
+
+
+def test_previous_window_slides_out(state_path, monkeypatch):
+    """Hits of the previous window count less as the current one advances"""
+    now = [1000.0]
+    monkeypatch.setattr(shared.time, "time", lambda: now[0])
+    limiter = SharedRateLimiter(SharedState(state_path, slots=64, stripes=4), 4, 10)
+
+    assert all(limiter.allow_request("client") for _ in range(4))
+    assert not limiter.allow_request("client")
+
+    now[0] = 1012.5  # three quarters of the last window still overlap
+    assert limiter.allow_request("client")
+    assert not limiter.allow_request("client")
+
+    now[0] = 1030.0
+    assert limiter.allow_request("client")
+    limiter.state.close()
+
+
+def test_counters_sum_worker_rows(state_path):
+    """Each state claims its own counter row and totals add up"""
+    first = SharedState(state_path, slots=64, stripes=4).open()
+    second = SharedState(state_path, slots=64, stripes=4).open()
+    first.count("requests")
+    second.count("requests", 2)
+    second.count("rate_limited")
+
+    assert first.row != second.row
+    assert first.counters() == {"requests": 3, "rate_limited": 1, "server_errors": 0}
+    first.close()
+    second.close()
+
+
+def test_rows_of_exited_workers_are_reused(state_path):
+    """A new worker takes over a dead worker's row and its counts, never a live one's"""
+    exited = multiprocessing.get_context("fork").Process(target=lambda: None)
+    exited.start()
+    exited.join()
+
+    first = SharedState(state_path, slots=64, stripes=4).open()
+    first.count("requests", 4)
+    live = SharedState(state_path, slots=64, stripes=4).open()
+    first.words[first.pid_word] = exited.pid  # first's worker has died
+
+    second = SharedState(state_path, slots=64, stripes=4).open()
+    assert second.row == first.row and second.row != live.row
+    second.count("requests")
+    assert second.counters()["requests"] == 5
+    for state in (first, live, second):
+        state.close()
+
+
+def test_full_bucket_shares_a_live_slot(state_path, monkeypatch):
+    """With every slot of a bucket live, a new client shares one instead of evicting it"""
+    monkeypatch.setattr(shared.time, "time", lambda: 1000.0)
+    limiter = SharedRateLimiter(SharedState(state_path, slots=8, stripes=1), 3, 60)
+    assert all(limiter.allow_request("heavy") for _ in range(3))
+    for i in range(7):
+        assert limiter.allow_request(f"client-{i}")
+
+    assert limiter.allow_request("newcomer")
+    assert limiter.allow_request("newcomer")
+    assert not limiter.allow_request("newcomer")
+    assert not limiter.allow_request("heavy")  # its count survived the newcomer
+    limiter.state.close()
+
+
+def test_other_launches_never_reset_a_live_segment(state_path, monkeypatch):
+    """Processes of another launch use their own file; a changed layout replaces, not truncates"""
+    parent = [1]
+    monkeypatch.setattr(shared.os, "getppid", lambda: parent[0])
+    live = SharedState(state_path, slots=64, stripes=4).open()
+    live.count("requests", 42)
+
+    parent[0] = 2  # e.g. pytest run inside the server's container
+    other = SharedState(state_path, slots=64, stripes=4).open()
+    assert other.file != live.file
+    other.close()
+
+    parent[0] = 1
+    resized = SharedState(state_path, slots=128, stripes=4).open()
+    assert resized.counters()["requests"] == 0
+    assert live.counters()["requests"] == 42  # still mapped, never truncated
+    for state in (live, resized):
+        state.close()
@@ -0,0 +1,131 @@
+"""Test property quantile sketches"""
+import random
+from datetime import datetime, timezone, timedelta
+
+import archive
+import sketches as sketches_module
+from sketches import Sketch, build_sketches, rebuild, SKETCH_RELATIVE_ACCURACY
+
+
+def stored(sketch: Sketch) -> dict:
+    """Sketch as it looks after $inc/$min/$max into an empty document"""
+    update = sketch.to_update()
+    doc = {
+        "min": update["$min"]["min"],
+        "max": update["$max"]["max"],
+        "positive": {},
+        "negative": {},
+    }
+    for key, value in update["$inc"].items():
+        if "." in key:
+            field, index = key.split(".")
+            doc[field][index] = value
+        else:
+            doc[key] = value
+    return doc
+
+
+def test_quantiles_within_relative_accuracy():
+    """Merged sketches answer quantiles within the configured relative error"""
+    rng = random.Random(42)
+    values = [rng.lognormvariate(4, 1) for _ in range(20_000)]
+    first, second = Sketch(), Sketch()
+    for i, value in enumerate(values):
+        (first if i % 2 else second).add(value)
+
+    merged = Sketch()
+    merged.merge_document(stored(first))
+    merged.merge_document(stored(second))
+
+    values.sort()
+    assert merged.count == len(values)
+    assert abs(merged.sum - sum(values)) < 1e-6 * sum(values)
+    for q in (0.5, 0.9, 0.99):
+        exact = values[int(q * (len(values) - 1))]
+        assert abs(merged.quantile(q) - exact) <= 2 * SKETCH_RELATIVE_ACCURACY * exact
+
+
+def test_zero_and_negative_values():
+    """Non-positive values are ordered before positive buckets"""
+    sketch = Sketch()
+    for value in (-10, 0, 0, 5):
+        sketch.add(value)
+    assert sketch.quantile(0) == -10
+    assert sketch.quantile(0.5) == 0.0
+    assert sketch.quantile(1) == 5
+
+
+def test_build_sketches_groups_by_utc_day_and_currency():
+    """Events are keyed by UTC day, event type, property and currency"""
+    kyiv = timezone(timedelta(hours=3))
+    sketches = build_sketches([
+        (datetime(2025, 8, 2, 1, 0, tzinfo=kyiv), "purchase", {"amount": 10.0, "currency": "USD"}),
+        (datetime(2025, 8, 1, 23, 0), "purchase", {"amount": 5, "currency": "USD"}),
+        (datetime(2025, 8, 1, 12, 0), "purchase", {"amount": 7, "currency": "EUR"}),
+        (datetime(2025, 8, 1, 12, 0), "login", {"method": "apple"}),
+    ])
+    usd = sketches[(datetime(2025, 8, 1), "purchase", "amount", "USD")]
+    assert usd.count == 2 and usd.sum == 15.0
+    assert sketches[(datetime(2025, 8, 1), "purchase", "amount", "EUR")].count == 1
+    assert len(sketches) == 2
+
+
+def test_non_finite_values_are_skipped():
+    """NaN and infinities never reach a sketch"""
+    day = datetime(2025, 8, 1, 12)
+    sketches = build_sketches([
+        (day, "purchase", {"amount": float("nan")}),
+        (day, "purchase", {"amount": float("inf")}),
+        (day, "purchase", {"amount": float("-inf"), "price": 2.5}),
+    ])
+    assert list(sketches) == [(datetime(2025, 8, 1), "purchase", "price", None)]
+    assert sketches[(datetime(2025, 8, 1), "purchase", "price", None)].sum == 2.5
+
+
+class MemoryCollection:
+    """The collection operations rebuild uses, in memory"""
+
+    def __init__(self, database, name):
+        self.database, self.name, self.ops = database, name, []
+
+    async def drop(self):
+        self.database.pop(self.name, None)
+
+    async def create_indexes(self, indexes):
+        pass
+
+    async def bulk_write(self, ops, ordered=True):
+        self.ops += ops
+
+    async def rename(self, name, dropTarget=False):
+        self.database.pop(self.name, None)
+        self.database[name], self.name = self, name
+
+
+class MemoryDatabase(dict):
+    def __missing__(self, name):
+        self[name] = MemoryCollection(self, name)
+        return self[name]
+
+
+async def test_rebuild_replaces_live_sketches_at_the_end(monkeypatch, tmp_path):
+    """Sketches are rebuilt aside, and the live collection is untouched until the swap"""
+    database = MemoryDatabase()
+    live = database["property_sketches"]
+    live.ops.append("stale")
+
+    async def events(query, fields):
+        assert database["property_sketches"].ops == ["stale"]
+        yield {"occurred_at": datetime(2025, 8, 1), "event_type": "purchase",
+               "properties": {"amount": 3}}
+
+    monkeypatch.setattr(archive, "ARCHIVE_DIR", str(tmp_path / "missing"))
+    monkeypatch.setattr(sketches_module, "find_events", events)
+    monkeypatch.setattr(
+        sketches_module.PropertySketchDocument, "get_motor_collection", lambda: live
+    )
+
+    assert await rebuild() == 1
+    assert list(database) == ["property_sketches"]
+    assert len(database["property_sketches"].ops) == 1
+    assert database["property_sketches"].ops[0] != "stale"
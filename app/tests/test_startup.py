@@ -0,0 +1,139 @@
+"""Test startup step tracking and the readiness probe"""
+import asyncio
+
+import pytest
+from httpx import AsyncClient
+
+import main
+import startup as startup_module
+from startup import Startup, READY, FAILED, RUNNING
+
+
+@pytest.mark.asyncio
+async def test_run_records_status_and_failure():
+    """Steps end ready or failed with their error, and report progress"""
+    tracker = Startup()
+
+    async def ok(report):
+        report(inserted=10)
+        return "done"
+
+    async def broken():
+        raise RuntimeError("no route to host")
+
+    assert await tracker.run("seed", ok, tracker.reporter("seed")) == "done"
+    assert await tracker.run("database", broken) is None
+
+    snapshot = tracker.snapshot()
+    assert snapshot["seed"]["status"] == READY
+    assert snapshot["seed"]["progress"] == {"inserted": 10}
+    assert snapshot["database"]["status"] == FAILED
+    assert snapshot["database"]["error"] == "no route to host"
+    assert "elapsed_ms" in snapshot["database"]
+
+
+@pytest.mark.asyncio
+async def test_retry_recovers_failed_step(monkeypatch):
+    """A failing step is retried with backoff until it succeeds"""
+    monkeypatch.setattr(startup_module, "STARTUP_RETRY_MAX_SECONDS", 0)
+    tracker = Startup()
+    attempts = []
+
+    async def flaky():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise ConnectionError("server selection timeout")
+
+    await tracker.spawn_retrying("database", flaky)
+
+    assert tracker.is_ready("database")
+    assert tracker.snapshot()["database"]["attempts"] == 3
+
+
+@pytest.mark.asyncio
+async def test_cancel_stops_background_tasks():
+    """Steps and plain tasks still running at shutdown are cancelled"""
+    tracker = Startup()
+    forever = tracker.start(asyncio.sleep, 3600)
+    step = tracker.spawn("columnar", asyncio.sleep, 3600)
+    await asyncio.sleep(0)
+    assert tracker.snapshot()["columnar"]["status"] == RUNNING
+
+    await tracker.cancel()
+
+    assert forever.cancelled() and step.cancelled()
+    assert tracker.snapshot()["columnar"]["status"] == FAILED
+
+
+@pytest.mark.asyncio
+async def test_ready_turns_200_when_dependencies_are_up(monkeypatch):
+    """/ready is 503 until database and queue are ready, then 200"""
+    tracker = Startup()
+    monkeypatch.setattr(main, "startup", tracker)
+    monkeypatch.setattr(main.messagemq, "connection", None)
+    tracker.register("database", "queue")
+
+    async def connected():
+        pass
+
+    async with AsyncClient(app=main.app, base_url="http://test") as client:
+        response = await client.get("/ready")
+        assert response.status_code == 503
+        assert response.json()["status"] == "starting"
+
+        await tracker.run("database", connected)
+        assert (await client.get("/ready")).status_code == 503
+
+        await tracker.run("queue", connected)
+        response = await client.get("/ready")
+        assert response.status_code == 200
+        assert response.json()["components"]["queue"]["status"] == READY
+
+
+@pytest.mark.asyncio
+async def test_database_endpoints_503_until_connected(monkeypatch):
+    """Queries and exports answer 503, not 500, while the database connects"""
+    tracker = Startup()
+    monkeypatch.setattr(main, "startup", tracker)
+    tracker.register("database")
+
+    async with AsyncClient(app=main.app, base_url="http://test") as client:
+        for path in ("/stats/dau?from_date=2025-08-01&to_date=2025-08-02", "/metrics",
+                     "/exports/25a4b866-040b-466f-945c-148e4720f511"):
+            response = await client.get(path)
+            assert response.status_code == 503
+            assert response.json()["detail"] == "Database is not connected yet"
+
+
+@pytest.mark.asyncio
+async def test_retention_matrix_waits_for_seed(monkeypatch):
+    """The matrix refresher starts only once the seed step is ready"""
+    tracker = Startup()
+    monkeypatch.setattr(main, "startup", tracker)
+    monkeypatch.setattr(main, "COLUMNAR_ENGINE", False)
+    monkeypatch.setattr(main, "RETENTION_MATRIX_REFRESH_SECONDS", 3600)
+    seeded, refreshing = asyncio.Event(), asyncio.Event()
+
+    async def connected(*args):
+        pass
+
+    async def seed(report):
+        await seeded.wait()
+
+    async def keep_current():
+        assert tracker.is_ready("seed")
+        refreshing.set()
+
+    monkeypatch.setattr(main, "connect_db", connected)
+    monkeypatch.setattr(main, "ensure_indexes", connected)
+    monkeypatch.setattr(main, "seed_csv", seed)
+    monkeypatch.setattr(main.cohorts, "keep_current", keep_current)
+
+    bootstrap = asyncio.create_task(main.bootstrap(True))
+    await asyncio.sleep(0.01)
+    assert not refreshing.is_set()
+
+    seeded.set()
+    await asyncio.wait_for(bootstrap, 1)
+    await asyncio.wait_for(refreshing.wait(), 1)
+    await tracker.cancel()
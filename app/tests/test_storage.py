@@ -0,0 +1,47 @@
+"""Test the compact event layout"""
+from datetime import datetime
+from uuid import UUID
+
+from bson.binary import Binary
+
+import storage
+from storage import COMPACT_FIELDS, index_models, to_stored, stored_filter, event_types
+
+
+def test_compact_indexes_use_short_keys():
+    """Compact indexes keep EventDocument's keys and uniqueness under short names"""
+    indexes = {model.document["name"]: model.document for model in index_models(compact=True)}
+
+    assert indexes["e_1"]["unique"] is True
+    assert list(indexes["t_1"]["key"]) == ["t"]
+    assert list(indexes["t_1_u_1"]["key"]) == ["t", "u"]
+
+
+async def test_to_stored_compact(monkeypatch):
+    """Compact documents use short keys and event_type codes"""
+    monkeypatch.setitem(event_types.codes, "view_item", 3)
+    monkeypatch.setitem(event_types.names, 3, "view_item")
+    event_id = UUID("12345678-1234-1234-1234-123456789abc")
+
+    doc = await to_stored({
+        "event_id": event_id,
+        "occurred_at": datetime(2025, 8, 21),
+        "user_id": 7,
+        "event_type": "view_item",
+        "properties": {"price": 1.5},
+    }, compact=True)
+
+    assert set(doc) == set(COMPACT_FIELDS.values())
+    assert doc["e"] == Binary.from_uuid(event_id)
+    assert doc["k"] == 3
+    assert await event_types.decode(doc["k"]) == "view_item"
+
+
+async def test_default_layout_is_unchanged():
+    """Without COMPACT_STORAGE filters and documents keep the long names"""
+    assert not storage.COMPACT_STORAGE
+    query = {"occurred_at": {"$gte": datetime(2025, 8, 21)}, "event_type": "view_item"}
+
+    assert await stored_filter(query) == query
+    doc = await to_stored({**query, "event_id": b"x", "user_id": 1, "occurred_at": None})
+    assert doc["event_type"] == "view_item"
@@ -0,0 +1,44 @@
+"""Test API to worker wire format"""
+import msgpack
+import pytest
+from datetime import datetime
+from uuid import UUID
+
+from models import EventInput
+from wire import encode_event, encode_batch, decode_batch, to_document, to_epoch_us
+
+
+def test_roundtrip_to_document():
+    """Encoded events decode to EventDocument-shaped raw documents"""
+    event = EventInput(
+        event_id=UUID("12345678-1234-1234-1234-123456789abc"),
+        occurred_at="2025-08-21T06:52:34.250+03:00",
+        user_id=7,
+        event_type="view_item",
+        properties={"price": 118.64, "tags": ["a", "b"]}
+    )
+    ingested_at = datetime(2025, 8, 22)
+
+    rows = decode_batch(encode_batch([encode_event(event)]))
+    doc = to_document(rows[0], ingested_at)
+
+    assert doc["event_id"].as_uuid() == event.event_id
+    assert doc["occurred_at"] == datetime(2025, 8, 21, 3, 52, 34, 250000)
+    assert doc["user_id"] == 7
+    assert doc["event_type"] == "view_item"
+    assert doc["properties"]["price"] == 118.64
+    assert doc["ingested_at"] == ingested_at
+
+
+def test_naive_timestamp_is_utc():
+    """Timestamps without an offset are taken as UTC"""
+    assert to_epoch_us("1970-01-01T00:00:01") == 1_000_000
+    assert to_epoch_us("1970-01-01T00:00:01Z") == 1_000_000
+
+
+def test_rejects_unknown_version():
+    """Legacy maps and other versions are not decoded as batches"""
+    with pytest.raises(ValueError):
+        decode_batch(msgpack.packb({"event_id": "x"}))
+    with pytest.raises(ValueError):
+        decode_batch(msgpack.packb([99, []]))
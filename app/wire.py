@@ -0,0 +1,61 @@
+"""Compact versioned wire format between API and worker"""
+from datetime import datetime, timedelta, timezone
+from typing import List, Sequence, Tuple
+
+import msgpack
+from bson.binary import Binary, UUID_SUBTYPE
+
+from models import EventInput
+
+# Envelope: [version, rows]
+# Row: [event_id (16 bytes), occurred_at (epoch us), user_id, event_type, properties]
+WIRE_VERSION = 1
+CONTENT_TYPE = "application/x-events-v1+msgpack"
+
+EPOCH = datetime(1970, 1, 1)
+EPOCH_UTC = datetime(1970, 1, 1, tzinfo=timezone.utc)
+MICROSECOND = timedelta(microseconds=1)
+
+
+def to_epoch_us(occurred_at: str) -> int:
+    """ISO-8601 to epoch microseconds (naive timestamps are UTC)"""
+    dt = datetime.fromisoformat(occurred_at.replace('Z', '+00:00'))
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return (dt - EPOCH_UTC) // MICROSECOND
+
+
+def encode_event(event: EventInput) -> list:
+    """Positional row for an already validated event"""
+    return [
+        event.event_id.bytes,
+        to_epoch_us(event.occurred_at),
+        event.user_id,
+        event.event_type,
+        event.properties,
+    ]
+
+
+def encode_batch(rows: List[list]) -> bytes:
+    return msgpack.packb([WIRE_VERSION, rows], use_bin_type=True)
+
+
+def decode_batch(body: bytes) -> Sequence[Tuple]:
+    """Rows of a batch envelope; the API has already validated every field"""
+    data = msgpack.unpackb(body, raw=False, use_list=False)
+    if not isinstance(data, tuple) or len(data) != 2 or data[0] != WIRE_VERSION:
+        raise ValueError("Unsupported wire format")
+    return data[1]
+
+
+def to_document(row: Tuple, ingested_at: datetime) -> dict:
+    """Logical event dict for a decoded row, ready for storage.to_stored"""
+    event_id, occurred_us, user_id, event_type, properties = row
+    return {
+        "event_id": Binary(event_id, UUID_SUBTYPE),
+        "occurred_at": EPOCH + timedelta(microseconds=occurred_us),
+        "user_id": user_id,
+        "event_type": event_type,
+        "properties": properties,
+        "ingested_at": ingested_at,
+    }
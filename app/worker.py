@@ -4,12 +4,19 @@ import logging
 import msgpack
 import signal
 from datetime import datetime
-from pymongo.errors import DuplicateKeyError
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 
-from models import EventInput, EventDocument
+from models import EventInput
 from db import connect_db, disconnect_db
-from messaging import connect_queue, disconnect_queue, messagemq
+from messaging import connect_queue, disconnect_queue, publish_dead_letter, messagemq
 from helpers import from_uuid_str
+from wire import CONTENT_TYPE, decode_batch, encode_batch, to_document
+from sketches import record_sketches
+from storage import events_collection, to_stored
+from profiling import profile_periodically
+from config import WORKER_PROFILE_EVERY_SECONDS, WORKER_PROFILE_SECONDS
+
+DUPLICATE_KEY = 11000
 
 logging.basicConfig(level=logging.WARNING, format='{"time":"%(asctime)s","msg":"%(message)s"}')
 logger = logging.getLogger(__name__)
@@ -22,6 +29,61 @@ class Worker:
         self.failed = 0
 
     async def process_message(self, message):
+        """Process a batch envelope, or a legacy single-event message"""
+        if message.content_type != CONTENT_TYPE:
+            return await self.process_legacy(message)
+
+        async with message.process(requeue=False, ignore_processed=True):
+            rows = []
+            try:
+                ingested_at = datetime.utcnow()
+                rows = decode_batch(message.body)
+                docs = [to_document(row, ingested_at) for row in rows]
+
+                stored, failed = docs, {}
+                try:
+                    await events_collection().insert_many(
+                        [await to_stored(doc) for doc in docs], ordered=False
+                    )
+                except BulkWriteError as e:
+                    # Duplicates are already stored; other failed rows are dead-lettered alone
+                    errors = e.details["writeErrors"]
+                    skipped = {err["index"] for err in errors}
+                    failed = {err["index"]: err["errmsg"] for err in errors
+                              if err["code"] != DUPLICATE_KEY}
+                    stored = [doc for i, doc in enumerate(docs) if i not in skipped]
+
+                # Sketches of inserted rows go in now: on replay they would be duplicates
+                await self.record_sketches(
+                    (doc["occurred_at"], doc["event_type"], doc["properties"]) for doc in stored
+                )
+
+                if failed:
+                    await publish_dead_letter(
+                        encode_batch([rows[i] for i in sorted(failed)]),
+                        next(iter(failed.values()))
+                    )
+                    self.failed += len(failed)
+                    logger.error(f"Dead-lettered {len(failed)} of {len(rows)} events")
+
+                before = self.processed
+                self.processed += len(docs) - len(failed)
+                if self.processed // 5000 > before // 5000:
+                    logger.warning(f"Processed: {self.processed}, Failed: {self.failed}")
+
+            except Exception as e:
+                self.failed += len(rows) or 1
+                logger.error(f"Error: {e}")
+                await message.reject(requeue=False)
+
+    async def record_sketches(self, events):
+        """Update property sketches; events are already stored, so failures are only logged"""
+        try:
+            await record_sketches(events)
+        except Exception as e:
+            logger.error(f"Sketch update failed: {e}")
+
+    async def process_legacy(self, message):
         """Process single event message"""
         async with message.process(requeue=False):
             try:
@@ -32,18 +94,19 @@ class Worker:
 
                 event = EventInput(**data)
 
-                doc = EventDocument(
-                    event_id=event.event_id,
-                    occurred_at=datetime.fromisoformat(event.occurred_at.replace('Z', '+00:00')),
-                    user_id=event.user_id,
-                    event_type=event.event_type,
-                    properties=event.properties,
-                    ingested_at=datetime.utcnow()
-                )
+                occurred_at = datetime.fromisoformat(event.occurred_at.replace('Z', '+00:00'))
+                doc = await to_stored({
+                    "event_id": event.event_id,
+                    "occurred_at": occurred_at,
+                    "user_id": event.user_id,
+                    "event_type": event.event_type,
+                    "properties": event.properties,
+                })
 
                 try:
-                    await doc.insert()
+                    await events_collection().insert_one(doc)
                     self.processed += 1
+                    await self.record_sketches([(occurred_at, event.event_type, event.properties)])
                 except DuplicateKeyError:
                     self.processed += 1
 
@@ -61,6 +124,11 @@ class Worker:
         await messagemq.events_queue.consume(self.process_message)
         logger.warning("Worker started")
 
+        if WORKER_PROFILE_EVERY_SECONDS > 0:
+            asyncio.create_task(profile_periodically(
+                "worker", WORKER_PROFILE_EVERY_SECONDS, WORKER_PROFILE_SECONDS
+            ))
+
         while self.running:
             await asyncio.sleep(1)
 